@@ -0,0 +1,86 @@
+#!/usr/bin/env	python3
+
+"""
+Benchmark of join_allele_matrices: times the merge of N synthetic _hashed_results.tsv
+files and compares it with the previous pairwise (join_df per sample) implementation.
+
+Usage: python benchmarks/bench_join_allele_matrices.py [--loci 7000] [--samples 100 200 400 800]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+import pandas
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from efsa_wgs_onehealth_facilitator import join_allele_matrices, join_df
+
+
+def write_samples(directory, n_samples, n_loci, seed=0):
+    """write n_samples sample directories with a _hashed_results.tsv each"""
+    rng = random.Random(seed)
+    header = "FILE\t" + "\t".join(
+        "INNUENDO_wgMLST-%08d.fasta" % locus for locus in range(n_loci)
+    )
+    sample_dirs = []
+    for i in range(n_samples):
+        sample = "SAMPLE%06d" % i
+        result_dir = os.path.join(directory, sample, "efsa_output")
+        os.makedirs(result_dir)
+        alleles = "\t".join(str(rng.getrandbits(32)) for _ in range(n_loci))
+        with open(os.path.join(result_dir, "_hashed_results.tsv"), "w") as outfile:
+            outfile.write(header + "\n" + sample + "_contigs.fa\t" + alleles + "\n")
+        sample_dirs.append(os.path.join(directory, sample))
+
+    return sample_dirs
+
+
+def legacy_join_allele_matrices(sample_dirs):
+    """pairwise merge used before the single concatenation (one join_df per sample)"""
+    df = pandas.DataFrame()
+    for directory in sample_dirs:
+        filename = os.path.join(directory, "efsa_output", "_hashed_results.tsv")
+        new_df = pandas.read_table(filename, dtype=str)
+        if len(df.columns) == 0:
+            df = new_df
+        elif new_df[new_df.columns[0]][0] not in df[df.columns[0]].values.tolist():
+            df = join_df(df, new_df)
+
+    return df
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--loci", type=int, default=7000)
+    parser.add_argument("--samples", type=int, nargs="+", default=[100, 200, 400, 800])
+    parser.add_argument("--legacy", action="store_true", help="also time the pairwise merge")
+    args = parser.parse_args()
+
+    print("samples\tloci\tseconds\tms_per_sample" + ("\tlegacy_seconds" if args.legacy else ""))
+    for n_samples in args.samples:
+        with tempfile.TemporaryDirectory() as directory:
+            sample_dirs = write_samples(directory, n_samples, args.loci)
+            start = time.perf_counter()
+            matrix = join_allele_matrices(sample_dirs, "")
+            elapsed = time.perf_counter() - start
+            assert matrix.values.shape == (n_samples, args.loci)
+            line = "%d\t%d\t%.3f\t%.2f" % (
+                n_samples,
+                args.loci,
+                elapsed,
+                1000 * elapsed / n_samples,
+            )
+            if args.legacy:
+                start = time.perf_counter()
+                legacy_join_allele_matrices(sample_dirs)
+                line += "\t%.3f" % (time.perf_counter() - start)
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
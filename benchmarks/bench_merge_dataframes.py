@@ -0,0 +1,98 @@
+#!/usr/bin/env	python3
+
+"""
+Benchmark of EfsaResults.merge_dataframes: times the merge of the AMR and pathotype tables of a
+previous report with the tables of the new samples, and compares it with the previous
+implementation (one python dict per row).
+
+Usage: python benchmarks/bench_merge_dataframes.py [--existing 1000 5000 20000] [--new 200]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+import pandas
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from efsa_parser import EfsaResults
+
+
+def amr_table(samples, rng):
+    """AMR table with 10 to 30 seq_variations per sample"""
+    rows = []
+    for sample in samples:
+        for i in range(rng.randint(10, 30)):
+            rows.append(
+                {
+                    "Analysis_ID": sample,
+                    "type": "seq_variation",
+                    "phenotypes": rng.choice(["-", "ciprofloxacin", "nalidixic acid, ciprofloxacin"]),
+                    "substitution": rng.random() < 0.5,
+                    "ref_database": "PointFinder",
+                    "codon_change": "gat->aat",
+                    "nucleotide_position": rng.randint(1, 3000),
+                    "Gene": "gene%03d" % i,
+                }
+            )
+
+    return pandas.DataFrame(rows)
+
+
+def pathotype_table(samples, rng):
+    """pathotype table with 5 to 15 genes per sample"""
+    rows = []
+    for sample in samples:
+        for i in range(rng.randint(5, 15)):
+            rows.append(
+                {
+                    "GeneName": "virulence%03d" % i,
+                    "Identity": round(rng.uniform(90, 100), 2),
+                    "Coverage": round(rng.uniform(90, 100), 2),
+                    "Analysis_ID": sample,
+                }
+            )
+
+    return pandas.DataFrame(rows)
+
+
+def legacy_merge_dataframes(dataframes):
+    """merge used before the columnar one (through a list of records)"""
+    dataframes_to_dicts = [df.to_dict(orient="records") for df in dataframes]
+    merged_list = [item for sublist in dataframes_to_dicts for item in sublist]
+
+    return pandas.DataFrame(merged_list)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--existing", type=int, nargs="+", default=[1000, 5000, 20000])
+    parser.add_argument("--new", type=int, default=200)
+    args = parser.parse_args()
+
+    results = EfsaResults({}, "", "")
+    rng = random.Random(0)
+    print("table\texisting_samples\trows\tseconds\tlegacy_seconds")
+    for n_existing in args.existing:
+        existing = ["OLD%06d" % i for i in range(n_existing)]
+        new = ["NEW%06d" % i for i in range(args.new)]
+        for name, make_table in [("amr", amr_table), ("pathotypes", pathotype_table)]:
+            dataframes = [make_table(existing, rng), make_table(new, rng)]
+            start = time.perf_counter()
+            merged = results.merge_dataframes(dataframes)
+            elapsed = time.perf_counter() - start
+            start = time.perf_counter()
+            legacy = legacy_merge_dataframes(dataframes)
+            legacy_elapsed = time.perf_counter() - start
+            assert merged.astype(str).equals(legacy.astype(str))
+            print(
+                "%s\t%d\t%d\t%.4f\t%.4f"
+                % (name, n_existing, len(merged.index), elapsed, legacy_elapsed)
+            )
+
+
+if __name__ == "__main__":
+    main()
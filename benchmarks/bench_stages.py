@@ -0,0 +1,381 @@
+#!/usr/bin/env	python3
+
+"""
+Benchmark of the stages of a run on synthetic samples: generates a fastq folder and a run folder with
+N sample directories (_parseresults.json, _hashed_results.tsv and, for failed samples, _logging.json)
+and measures the wall time, cpu time and peak memory of distribute_fastq, join_allele_matrices,
+EfsaResults.parse_all_results, EfsaResults.merge_output and prepare_final_reports separately.
+
+Each stage runs in a fresh process, after its inputs were prepared, so its peak memory is not mixed
+with the one of the other stages (the peak is reset before the stage where /proc/self/clear_refs is
+available, i.e. on Linux). The results are printed as a table and, with --json, written to a json file
+together with the parameters and the environment, so that they can be compared between versions.
+
+Usage: python benchmarks/bench_stages.py [--samples 10 100 1000] [--loci 7000] [--failure-rate 0.05]
+       [--stages join_allele_matrices parse_all_results] [--parse-jobs 1] [--repeat 1] [--json results.json]
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy
+import pandas
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from efsa_parser import EfsaResults
+from efsa_store import RunStore
+from efsa_wgs_onehealth_facilitator import (
+    distribute_fastq,
+    join_allele_matrices,
+    join_reports_efsa_parser,
+    prepare_final_reports,
+)
+
+STAGES = [
+    "distribute_fastq",
+    "join_allele_matrices",
+    "parse_all_results",
+    "merge_output",
+    "prepare_final_reports",
+]
+OUTPUT_FOLDER = "efsa_output"
+
+
+# synthetic samples ----------
+
+
+def sample_names(n_samples):
+    return ["SAMPLE%06d" % i for i in range(n_samples)]
+
+
+def write_fastq_directory(directory, n_samples, fastq_size, seed=0):
+    """write a pair of fastq files of fastq_size bytes per sample (as given to --fastq)"""
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    for sample in sample_names(n_samples):
+        for read in ["1", "2"]:
+            with open(os.path.join(directory, sample + "_" + read + ".fastq.gz"), "wb") as outfile:
+                outfile.write(rng.getrandbits(8 * fastq_size).to_bytes(fastq_size, "little"))
+
+
+def parse_results(rng):
+    """_parseresults.json of a sample with 2 to 12 pathotype genes and 5 to 40 AMR genes/variants"""
+    species = "escherichia coli"
+    n_pathotype_genes = rng.randint(2, 12)
+    n_amr = rng.randint(5, 40)
+    phenotypes = ["ciprofloxacin", "nalidixic acid", "ampicillin", "tetracycline", "colistin"]
+
+    return {
+        "QualityCheck": {
+            "Fastp": {
+                "ReadMeanLength": rng.randint(120, 150),
+                "Q30Rate": round(rng.uniform(0.85, 0.95), 4),
+                "TotalBases": rng.randint(300000000, 900000000),
+            },
+            "ContaminationCheck": {
+                "Mash": {"MashSpeciesDetected": species},
+                "Kraken": {"GenusDetected": "Escherichia", "NumberContaminatedSNVs": rng.randint(0, 10)},
+            },
+            "AssemblyQualityStatistics": {
+                "Quast": {
+                    "N50Contigs": rng.randint(50000, 300000),
+                    "GenomeSize": rng.randint(4800000, 5400000),
+                    "NumberContigs": rng.randint(50, 300),
+                },
+                "QC": {"OverallAssemblyQC": True},
+            },
+            "cgMLSTQC": {"NumberMissingLoci": rng.randint(0, 30), "NumberMissingLociQCPassed": True},
+        },
+        "Results": {
+            "SpeciesDetermination": {"Species": species},
+            "PredictedPathotype": {
+                "Pathotype": rng.choice(["STEC", "EPEC", "ETEC", "-"]),
+                "VT1Positive": rng.random() < 0.5,
+                "GeneList": [
+                    {
+                        "GeneName": "virulence%03d" % rng.randint(0, 200),
+                        "Identity": round(rng.uniform(90, 100), 2),
+                        "Coverage": round(rng.uniform(90, 100), 2),
+                    }
+                    for _ in range(n_pathotype_genes)
+                ],
+                "Software": "patho_typing",
+            },
+            "AMRProfile": {
+                "NumberPredictedAMResistance": n_amr,
+                "GeneList": [],
+                "seq_variations": [
+                    {
+                        "gene%03d_%d" % (i, rng.randint(1, 3000)): {
+                            "type": "seq_variation",
+                            "phenotypes": rng.sample(phenotypes, rng.randint(0, 2)),
+                            "substitution": rng.random() < 0.5,
+                            "ref_database": "PointFinder",
+                            "codon_change": "gat->aat",
+                            "nucleotide_position": rng.randint(1, 3000),
+                            "genes": ["gene%03d" % rng.randint(0, 300)],
+                        }
+                    }
+                    for i in range(n_amr)
+                ],
+                "Software": "resfinder-4.1.5",
+            },
+            "PredictedSerotype": {"Serotype": rng.choice(["O157:H7", "O26:H11", "O103:H2"]), "Software": "seq_typing"},
+            "MLSTSequenceType": {
+                "ST": str(rng.randint(1, 50)),
+                "GeneList": [{gene: rng.randint(1, 500) for gene in ["adk", "fumC", "gyrB", "icd", "mdh", "purA", "recA"]}],
+                "Software": "mlst",
+            },
+            "Software": "eurl",
+        },
+    }
+
+
+def write_run_directory(directory, n_samples, n_loci, failure_rate, seed=0):
+    """
+    write the sample directories of a run as left by the EFSA pipeline: an output folder with
+    _parseresults.json and _hashed_results.tsv, or only _logging.json for the failed samples
+    output: list of sample directories
+    """
+    rng = random.Random(seed)
+    header = "FILE\t" + "\t".join("INNUENDO_wgMLST-%08d.fasta" % locus for locus in range(n_loci))
+    # a few alleles per locus, as in real profiles (0 = missing locus)
+    alleles = [[str(rng.getrandbits(32)) for _ in range(4)] + ["0"] for _ in range(n_loci)]
+    sample_dirs = []
+    for sample in sample_names(n_samples):
+        sample_dir = os.path.join(directory, sample)
+        output = os.path.join(sample_dir, OUTPUT_FOLDER)
+        os.makedirs(output, exist_ok=True)
+        sample_dirs.append(sample_dir)
+        if rng.random() < failure_rate:
+            with open(os.path.join(output, "_logging.json"), "w") as outfile:
+                json.dump(
+                    {"status": "failed", "errors": [{"title": "Insufficient coverage", "step": "assembly"}]},
+                    outfile,
+                    indent=4,
+                )
+            continue
+        with open(os.path.join(output, "_parseresults.json"), "w") as outfile:
+            json.dump(parse_results(rng), outfile, indent=4)
+        profile = "\t".join(rng.choice(choices) for choices in alleles)
+        with open(os.path.join(output, "_hashed_results.tsv"), "w") as outfile:
+            outfile.write(header + "\n" + sample + "_contigs.fa\t" + profile + "\n")
+
+    return sample_dirs
+
+
+# measurements ----------
+
+
+def current_rss_mb():
+    try:
+        with open("/proc/self/statm") as infile:
+            return int(infile.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024**2
+    except OSError:
+        return float("nan")
+
+
+def reset_peak_rss():
+    """reset the peak resident memory of the process (False if it is not supported)"""
+    try:
+        with open("/proc/self/clear_refs", "w") as outfile:
+            outfile.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb(reset):
+    if reset:
+        with open("/proc/self/status") as infile:
+            return int(re.search(r"VmHWM:\s+(\d+)", infile.read()).group(1)) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def children_cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def prepare_stage(stage, params, scratch):
+    """inputs of a stage (not measured); returns the function running the stage and counting its items"""
+
+    run_dir = params["run_directory"]
+    sample_dirs = [os.path.join(run_dir, sample) for sample in sample_names(params["samples"])]
+    dir_to_sample = {
+        os.path.basename(directory): os.path.join(directory, OUTPUT_FOLDER)
+        for directory in sample_dirs
+        if os.path.exists(os.path.join(directory, OUTPUT_FOLDER, "_parseresults.json"))
+    }
+
+    if stage == "distribute_fastq":
+        outdir = os.path.join(scratch, "staged")
+
+        def run():
+            staged, names = distribute_fastq(
+                params["fastq_directory"], "", outdir, False, params["stage_mode"], params["stage_jobs"]
+            )
+            return 2 * len(staged)
+
+    elif stage == "join_allele_matrices":
+
+        def run():
+            return len(join_allele_matrices(sample_dirs, "").samples)
+
+    elif stage == "parse_all_results":
+
+        def run():
+            results = EfsaResults(dir_to_sample, "", "", workers=params["parse_jobs"])
+            results.parse_all_results()
+            return len(results.parsed_results)
+
+    elif stage == "merge_output":
+        results = EfsaResults(dir_to_sample, scratch, "report.xlsx", workers=params["parse_jobs"])
+        results.parse_all_results()
+
+        def run():
+            results.merge_output()
+            return len(pandas.read_table(os.path.join(scratch, "summary.tsv")).index)
+
+    elif stage == "prepare_final_reports":
+        store = RunStore.create(os.path.join(scratch, "run"), "report.xlsx")
+        os.makedirs(store.own_partition, exist_ok=True)
+        store.write_partition_alleles(join_allele_matrices(sample_dirs, ""))
+        failed, reports = join_reports_efsa_parser(sample_dirs, params["parse_jobs"])
+
+        def run():
+            prepare_final_reports(failed, store, reports, False)
+            return len(pandas.read_table(os.path.join(store.run_directory, "summary.tsv")).index)
+
+    else:
+        raise ValueError("unknown stage " + stage)
+
+    return run
+
+
+def measure_stage(stage, params, queue):
+    """run one stage in this (fresh) process and put its measurements in the queue"""
+
+    scratch = tempfile.mkdtemp(dir=params["directory"])
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            run = prepare_stage(stage, params, scratch)
+            start_rss = current_rss_mb()
+            reset = reset_peak_rss()
+            children_cpu = children_cpu_seconds()
+            cpu = time.process_time()
+            wall = time.perf_counter()
+            items = run()
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            children_cpu = children_cpu_seconds() - children_cpu
+            peak = peak_rss_mb(reset)
+        queue.put(
+            {
+                "stage": stage,
+                "items": items,
+                "wall_seconds": round(wall, 4),
+                "cpu_seconds": round(cpu, 4),
+                "children_cpu_seconds": round(children_cpu, 4),
+                "start_rss_mb": round(start_rss, 1),
+                "peak_rss_mb": round(peak, 1),
+                "children_peak_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+                "peak_reset": reset,
+            }
+        )
+    except Exception as error:
+        queue.put({"stage": stage, "error": repr(error)})
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def run_stage(stage, params):
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=measure_stage, args=(stage, params, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+
+    return result
+
+
+def environment():
+    return {
+        "date": str(datetime.datetime.now()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "numpy": numpy.__version__,
+        "pandas": pandas.__version__,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--samples", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--loci", type=int, default=7000)
+    parser.add_argument("--failure-rate", type=float, default=0.05, help="fraction of samples with only a _logging.json")
+    parser.add_argument("--fastq-size", type=int, default=64 * 1024, help="size (bytes) of each synthetic fastq file")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--stage-mode", default="copy", choices=["copy", "hardlink", "reflink", "symlink"])
+    parser.add_argument("--stage-jobs", type=int, default=1)
+    parser.add_argument("--parse-jobs", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=1, help="number of measurements of each stage")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--directory", default=None, help="folder for the synthetic data (default: a temporary folder)")
+    parser.add_argument("--json", default="", help="also write the results to this json file")
+    args = parser.parse_args()
+
+    report = {
+        "environment": environment(),
+        "parameters": {key: value for key, value in vars(args).items() if key not in ["directory", "json"]},
+        "results": [],
+    }
+    columns = ["samples", "stage", "repeat", "items", "wall_seconds", "cpu_seconds", "children_cpu_seconds", "peak_rss_mb"]
+    print("\t".join(columns))
+    with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+        for n_samples in args.samples:
+            data = os.path.join(directory, str(n_samples))
+            params = {
+                "directory": data,
+                "run_directory": os.path.join(data, "run"),
+                "fastq_directory": os.path.join(data, "fastq"),
+                "samples": n_samples,
+                "stage_mode": args.stage_mode,
+                "stage_jobs": args.stage_jobs,
+                "parse_jobs": args.parse_jobs,
+            }
+            if "distribute_fastq" in args.stages:
+                write_fastq_directory(params["fastq_directory"], n_samples, args.fastq_size, args.seed)
+            write_run_directory(params["run_directory"], n_samples, args.loci, args.failure_rate, args.seed)
+            for stage in args.stages:
+                for repeat in range(args.repeat):
+                    result = dict(run_stage(stage, params), samples=n_samples, loci=args.loci, repeat=repeat)
+                    report["results"].append(result)
+                    if "error" in result:
+                        print("%d\t%s\t%d\terror: %s" % (n_samples, stage, repeat, result["error"]))
+                    else:
+                        print("\t".join(str(result[column]) for column in columns))
+            shutil.rmtree(data, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w") as outfile:
+            json.dump(report, outfile, indent=4)
+
+
+if __name__ == "__main__":
+    main()
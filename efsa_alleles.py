@@ -0,0 +1,467 @@
+import json
+import os
+
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+
+MISSING = 0
+UINT32_MAX = 2**32 - 1
+
+
+def encode_alleles(values: List[str]) -> Tuple[np.ndarray, Dict[int, str]]:
+    """
+    convert hashed allele calls (CRC32 as text) to uint32. Calls that are not a hash (e.g. "-" or "LNF")
+    become MISSING and are also returned as they were (position -> call), so they can be written back.
+    """
+    encoded = np.zeros(len(values), dtype=np.uint32)
+    missing_calls = {}
+    for i, value in enumerate(values):
+        if value.isdigit() and int(value) <= UINT32_MAX and str(int(value)) == value:
+            encoded[i] = int(value)
+        else:
+            missing_calls[i] = value
+
+    return encoded, missing_calls
+
+
+def select_calls(missing_calls: Dict[str, Dict[str, str]], samples: List[str]) -> Dict[str, Dict[str, str]]:
+    """missing calls (sample -> locus -> call) of the given samples"""
+    return {sample: missing_calls[sample] for sample in samples if sample in missing_calls}
+
+
+class AlleleMatrix:
+    """
+    samples x loci matrix of hashed allele calls stored as uint32 (MISSING = 0)
+
+    A call of 0 is how the pipeline reports a missing locus, so a hash that is 0 cannot be told apart
+    from it. Calls that are not a hash at all (e.g. "-" or "LNF") are stored as MISSING too, so they
+    are never compared, and kept as they were in missing_calls (sample -> locus -> call), so the
+    exported alleles.tsv has the calls of the pipeline.
+
+    On disk it is kept as a raw little-endian uint32 file (alleles.bin) plus a json index
+    with the sample and locus names and the missing calls (alleles.index.json), so it can be
+    memory-mapped back without parsing.
+    """
+
+    data_file = "alleles.bin"
+    index_file = "alleles.index.json"
+    dtype = np.dtype("<u4")
+    format_version = 1
+
+    def __init__(
+        self,
+        samples: List[str],
+        loci: List[str],
+        values: np.ndarray,
+        id_column: str = "FILE",
+        missing_calls: Optional[Dict[str, Dict[str, str]]] = None,
+    ) -> None:
+
+        if values.shape != (len(samples), len(loci)):
+            raise ValueError(
+                f"Allele matrix shape {values.shape} does not match {len(samples)} samples x {len(loci)} loci"
+            )
+        self.samples = list(samples)
+        self.loci = list(loci)
+        self.values = values
+        self.id_column = id_column
+        self.missing_calls = missing_calls if missing_calls is not None else {}
+
+    def __len__(self):
+        return len(self.samples)
+
+    @classmethod
+    def empty(cls, loci: List[str], id_column: str = "FILE") -> "AlleleMatrix":
+        return cls([], loci, np.zeros((0, len(loci)), dtype=cls.dtype), id_column)
+
+    @classmethod
+    def from_tsv(cls, filename: str) -> "AlleleMatrix":
+        with open(filename) as infile:
+            header = infile.readline().rstrip("\n").split("\t")
+            samples = []
+            values = []
+            missing_calls = {}
+            for line in infile:
+                row = line.rstrip("\n").split("\t")
+                if len(row) > 1:
+                    samples.append(row[0])
+                    encoded, calls = encode_alleles(row[1:])
+                    values.append(encoded)
+                    if calls:
+                        missing_calls[row[0]] = {header[i + 1]: call for i, call in calls.items()}
+
+        if values:
+            values = np.vstack(values)
+        else:
+            values = np.zeros((0, len(header) - 1), dtype=cls.dtype)
+
+        return cls(samples, header[1:], values, header[0], missing_calls)
+
+    @classmethod
+    def exists(cls, directory: str) -> bool:
+        return os.path.exists(os.path.join(directory, cls.index_file)) and os.path.exists(
+            os.path.join(directory, cls.data_file)
+        )
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True) -> "AlleleMatrix":
+        """load the binary matrix, memory-mapped (read-only) unless mmap is False"""
+
+        with open(os.path.join(directory, cls.index_file)) as infile:
+            index = json.load(infile)
+
+        shape = (len(index["samples"]), len(index["loci"]))
+        data_file = os.path.join(directory, cls.data_file)
+        if shape[0] == 0 or shape[1] == 0:
+            values = np.zeros(shape, dtype=cls.dtype)
+        elif mmap:
+            values = np.memmap(data_file, dtype=cls.dtype, mode="r", shape=shape)
+        else:
+            values = np.fromfile(data_file, dtype=cls.dtype).reshape(shape)
+
+        return cls(index["samples"], index["loci"], values, index["id_column"], index.get("missing_calls", {}))
+
+    def save(self, directory: str):
+        """write the binary matrix and its index to directory"""
+
+        np.ascontiguousarray(self.values, dtype=self.dtype).tofile(
+            os.path.join(directory, self.data_file)
+        )
+        with open(os.path.join(directory, self.index_file), "w") as outfile:
+            json.dump(
+                {
+                    "format_version": self.format_version,
+                    "dtype": self.dtype.str,
+                    "missing": MISSING,
+                    "id_column": self.id_column,
+                    "samples": self.samples,
+                    "loci": self.loci,
+                    "missing_calls": self.missing_calls,
+                },
+                outfile,
+            )
+
+    @classmethod
+    def append_chunks(cls, directory: str, chunks: Iterable["AlleleMatrix"]):
+        """
+        add the samples of consecutive matrices (e.g. the blocks of rows of a partition) after the ones of the
+        matrix saved in directory. The saved rows are never read: the new rows are written at the end of the
+        data file and the index is replaced once they are all there, so an interrupted append leaves the
+        previous matrix as it was.
+        """
+
+        index_file = os.path.join(directory, cls.index_file)
+        with open(index_file) as infile:
+            index = json.load(infile)
+        present = set(index["samples"])
+        samples = []
+        with open(os.path.join(directory, cls.data_file), "r+b") as outfile:
+            # drop the rows of an append interrupted before its index was written
+            outfile.truncate(len(index["samples"]) * len(index["loci"]) * cls.dtype.itemsize)
+            outfile.seek(0, os.SEEK_END)
+            for chunk in chunks:
+                if set(chunk.loci) != set(index["loci"]):
+                    raise ValueError("Column names do not match between the allele matrices")
+                for sample in chunk.samples:
+                    if sample in present:
+                        raise ValueError(f"{sample} is already present in the allele matrix of {directory}")
+                    present.add(sample)
+                np.ascontiguousarray(chunk.select_loci(index["loci"]).values, dtype=cls.dtype).tofile(outfile)
+                samples.extend(chunk.samples)
+                index.setdefault("missing_calls", {}).update(chunk.missing_calls)
+        index["samples"].extend(samples)
+        with open(index_file + ".tmp", "w") as outfile:
+            json.dump(index, outfile)
+        os.replace(index_file + ".tmp", index_file)
+
+    def iter_chunks(self, chunk_rows: int = 4096) -> Iterator["AlleleMatrix"]:
+        """the matrix as consecutive blocks of rows, each one read into memory on its own"""
+        for row in range(0, len(self.samples), chunk_rows):
+            samples = self.samples[row : row + chunk_rows]
+            yield AlleleMatrix(
+                samples,
+                self.loci,
+                np.asarray(self.values[row : row + chunk_rows]),
+                self.id_column,
+                select_calls(self.missing_calls, samples),
+            )
+
+    def take(self, positions: List[int]) -> "AlleleMatrix":
+        """matrix with the rows at positions (only those rows are read from a memory-mapped matrix)"""
+
+        positions = np.asarray(positions, dtype=np.int64)
+        values = np.asarray(self.values[positions]).reshape(len(positions), len(self.loci))
+        samples = [self.samples[i] for i in positions.tolist()]
+
+        return AlleleMatrix(samples, self.loci, values, self.id_column, select_calls(self.missing_calls, samples))
+
+    def to_tsv(self, filename: str, append: bool = False):
+        """
+        export the matrix in the hashed alleles.tsv format (only its rows, at the end of filename, if append),
+        with the missing calls as they were reported
+        """
+
+        position = {locus: i for i, locus in enumerate(self.loci)}
+        with open(filename, "a" if append else "w") as outfile:
+            if not append:
+                outfile.write("\t".join([self.id_column] + self.loci) + "\n")
+            for sample, row in zip(self.samples, self.values):
+                calls = list(map(str, row.tolist()))
+                for locus, call in self.missing_calls.get(sample, {}).items():
+                    calls[position[locus]] = call
+                outfile.write(sample + "\t" + "\t".join(calls) + "\n")
+
+    @staticmethod
+    def concatenate(matrices: List["AlleleMatrix"]) -> "AlleleMatrix":
+        """stack several matrices (loci in the order of the first one) with a single allocation"""
+
+        first = matrices[0]
+        values = []
+        samples = []
+        missing_calls = {}
+        for matrix in matrices:
+            if set(matrix.loci) != set(first.loci):
+                raise ValueError("Column names do not match between the allele matrices")
+            values.append(matrix.select_loci(first.loci).values)
+            samples.extend(matrix.samples)
+            missing_calls.update(matrix.missing_calls)
+
+        return AlleleMatrix(samples, first.loci, np.concatenate(values), first.id_column, missing_calls)
+
+    def select_loci(self, loci: List[str]) -> "AlleleMatrix":
+        """matrix with the loci in the given order (itself if they are already in that order)"""
+
+        if loci == self.loci:
+            return self
+        position = {locus: i for i, locus in enumerate(self.loci)}
+        values = self.values[:, [position[locus] for locus in loci]]
+
+        return AlleleMatrix(self.samples, loci, values, self.id_column, self.missing_calls)
+
+    def sample_index(self) -> dict:
+        """sample name -> row of the matrix"""
+        return {sample: i for i, sample in enumerate(self.samples)}
+
+
+def code_dtype(n_codes: int) -> np.dtype:
+    """smallest unsigned integer type holding the codes 0..n_codes"""
+    for dtype in [np.dtype("<u1"), np.dtype("<u2")]:
+        if n_codes <= np.iinfo(dtype).max:
+            return dtype
+    return np.dtype("<u4")
+
+
+class EncodedAlleleMatrix:
+    """
+    samples x loci matrix of allele codes with one dictionary per locus
+
+    Each locus has the sorted distinct hashes called at it (its dictionary) and the allele of a sample is
+    stored as its position in the dictionary plus one (0 = MISSING), as uint8 when no locus has more than
+    255 alleles (uint16 up to 65535). On disk it is kept as alleles.codes.bin (raw codes),
+    alleles.dictionary.bin (the dictionaries one after the other, uint32) and alleles.codes.index.json
+    (sample and locus names, code type, size of each dictionary and the missing calls of the matrix, see
+    AlleleMatrix).
+
+    Two samples have the same allele at a locus when they have the same code, so distances can be computed
+    on the codes. Profiles from elsewhere (e.g. the samples of a later run) are compared after translating
+    their alleles into the dictionaries of the matrix (see translate).
+    """
+
+    codes_file = "alleles.codes.bin"
+    dictionary_file = "alleles.dictionary.bin"
+    index_file = "alleles.codes.index.json"
+    format_version = 1
+
+    def __init__(
+        self,
+        samples: List[str],
+        loci: List[str],
+        codes: np.ndarray,
+        dictionary: np.ndarray,
+        dictionary_sizes: np.ndarray,
+        id_column: str = "FILE",
+        missing_calls: Optional[Dict[str, Dict[str, str]]] = None,
+    ) -> None:
+
+        if codes.shape != (len(samples), len(loci)) or len(dictionary_sizes) != len(loci):
+            raise ValueError(
+                f"Allele codes shape {codes.shape} does not match {len(samples)} samples x {len(loci)} loci"
+            )
+        self.samples = list(samples)
+        self.loci = list(loci)
+        self.codes = codes
+        # dictionaries of all the loci one after the other
+        self.dictionary = dictionary
+        self.dictionary_sizes = np.asarray(dictionary_sizes, dtype=np.int64)
+        self.id_column = id_column
+        self.missing_calls = missing_calls if missing_calls is not None else {}
+
+    def __len__(self):
+        return len(self.samples)
+
+    @property
+    def dictionary_starts(self) -> np.ndarray:
+        """position of the dictionary of each locus in self.dictionary"""
+        return np.concatenate([[0], np.cumsum(self.dictionary_sizes)[:-1]]).astype(np.int64)
+
+    @staticmethod
+    def locus_keys(values: np.ndarray) -> np.ndarray:
+        """locus position (high 32 bits) and allele hash (low 32 bits) of every cell"""
+        loci = np.arange(values.shape[1], dtype=np.uint64) << np.uint64(32)
+        return loci[None, :] | values.astype(np.uint64)
+
+    @classmethod
+    def encode(
+        cls, matrix: AlleleMatrix, keys: Optional[np.ndarray] = None, chunk_rows: int = 4096
+    ) -> "EncodedAlleleMatrix":
+        """
+        encode the allele matrix, with the dictionaries of its own alleles or with the given sorted
+        locus keys (see locus_keys), which must include all its alleles
+        """
+
+        n_loci = len(matrix.loci)
+        if keys is None:
+            keys = np.zeros(0, dtype=np.uint64)
+            for row in range(0, len(matrix.samples), chunk_rows):
+                chunk = np.asarray(matrix.values[row : row + chunk_rows])
+                keys = np.union1d(keys, cls.locus_keys(chunk)[chunk != MISSING])
+        sizes = np.bincount((keys >> np.uint64(32)).astype(np.int64), minlength=n_loci)
+        starts = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.int64)
+        codes = np.zeros((len(matrix.samples), n_loci), dtype=code_dtype(int(sizes.max(initial=0))))
+        for row in range(0, len(matrix.samples), chunk_rows):
+            chunk = np.asarray(matrix.values[row : row + chunk_rows])
+            positions = np.searchsorted(keys, cls.locus_keys(chunk)).astype(np.int64)
+            codes[row : row + len(chunk)] = np.where(chunk == MISSING, 0, positions - starts[None, :] + 1)
+
+        dictionary = (keys & np.uint64(UINT32_MAX)).astype(AlleleMatrix.dtype)
+
+        return cls(matrix.samples, matrix.loci, codes, dictionary, sizes, matrix.id_column, matrix.missing_calls)
+
+    def keys(self) -> np.ndarray:
+        """sorted locus keys of the dictionaries (see locus_keys)"""
+        loci = np.repeat(np.arange(len(self.loci), dtype=np.uint64), self.dictionary_sizes)
+        return (loci << np.uint64(32)) | self.dictionary.astype(np.uint64)
+
+    def decode_codes(self, codes: np.ndarray) -> np.ndarray:
+        """allele hashes of rows of codes"""
+
+        # dictionaries with MISSING in front of each one, so that code c of a locus is at its start + c
+        table = np.insert(self.dictionary, self.dictionary_starts, MISSING)
+        table_starts = self.dictionary_starts + np.arange(len(self.loci))
+
+        return table[table_starts[None, :] + codes].astype(AlleleMatrix.dtype).reshape(codes.shape)
+
+    def decode(self, rows: Optional[slice] = None) -> AlleleMatrix:
+        """allele matrix with the hashes of the codes (of the given rows, all by default)"""
+
+        rows = rows if rows is not None else slice(None)
+        values = self.decode_codes(np.asarray(self.codes[rows]))
+        samples = self.samples[rows]
+
+        return AlleleMatrix(samples, self.loci, values, self.id_column, select_calls(self.missing_calls, samples))
+
+    def iter_chunks(self, chunk_rows: int = 4096) -> Iterator[AlleleMatrix]:
+        """the decoded matrix as consecutive blocks of rows, each one decoded on its own"""
+        for row in range(0, len(self.samples), chunk_rows):
+            yield self.decode(slice(row, row + chunk_rows))
+
+    def take(self, positions: List[int]) -> AlleleMatrix:
+        """decoded matrix with the rows at positions (only those rows are read from memory-mapped codes)"""
+
+        positions = np.asarray(positions, dtype=np.int64)
+        codes = np.asarray(self.codes[positions]).reshape(len(positions), len(self.loci))
+        samples = [self.samples[i] for i in positions.tolist()]
+
+        return AlleleMatrix(
+            samples, self.loci, self.decode_codes(codes), self.id_column, select_calls(self.missing_calls, samples)
+        )
+
+    def iter_code_chunks(self, chunk_rows: int = 4096) -> Iterator[np.ndarray]:
+        """the codes as consecutive blocks of rows, each one read into memory on its own"""
+        for row in range(0, len(self.samples), chunk_rows):
+            yield np.asarray(self.codes[row : row + chunk_rows])
+
+    @property
+    def unknown_code(self) -> int:
+        """code given by translate to the alleles that are not in the dictionaries (it matches no sample)"""
+        return int(self.dictionary_sizes.max(initial=0)) + 1
+
+    def translate(self, matrix: AlleleMatrix) -> np.ndarray:
+        """
+        codes of the alleles of matrix (with the loci of this matrix, in the same order) in the dictionaries
+        of this matrix. Alleles that are not in them get unknown_code, so they differ from the alleles of
+        every sample of this matrix, and missing alleles stay MISSING.
+        """
+
+        if matrix.loci != self.loci:
+            raise ValueError("The allele matrices do not have the same loci in the same order")
+        keys = self.keys()
+        values = np.asarray(matrix.values)
+        wanted = self.locus_keys(values)
+        positions = np.searchsorted(keys, wanted).astype(np.int64)
+        if len(keys) > 0:
+            found = keys[np.minimum(positions, len(keys) - 1)] == wanted
+        else:
+            found = np.zeros(values.shape, dtype=bool)
+        codes = np.where(found, positions - self.dictionary_starts[None, :] + 1, self.unknown_code)
+
+        return np.where(values == MISSING, MISSING, codes).astype(code_dtype(self.unknown_code))
+
+    @classmethod
+    def exists(cls, directory: str) -> bool:
+        return all(
+            os.path.exists(os.path.join(directory, filename))
+            for filename in [cls.index_file, cls.codes_file, cls.dictionary_file]
+        )
+
+    def save(self, directory: str):
+        """write the codes, the dictionaries and the index to directory"""
+
+        np.ascontiguousarray(self.codes).tofile(os.path.join(directory, self.codes_file))
+        np.ascontiguousarray(self.dictionary, dtype=AlleleMatrix.dtype).tofile(
+            os.path.join(directory, self.dictionary_file)
+        )
+        with open(os.path.join(directory, self.index_file), "w") as outfile:
+            json.dump(
+                {
+                    "format_version": self.format_version,
+                    "dtype": self.codes.dtype.str,
+                    "missing": MISSING,
+                    "id_column": self.id_column,
+                    "samples": self.samples,
+                    "loci": self.loci,
+                    "dictionary_sizes": self.dictionary_sizes.tolist(),
+                    "missing_calls": self.missing_calls,
+                },
+                outfile,
+            )
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True) -> "EncodedAlleleMatrix":
+        """load the matrix, with the codes memory-mapped (read-only) unless mmap is False"""
+
+        with open(os.path.join(directory, cls.index_file)) as infile:
+            index = json.load(infile)
+
+        dtype = np.dtype(index["dtype"])
+        shape = (len(index["samples"]), len(index["loci"]))
+        codes_file = os.path.join(directory, cls.codes_file)
+        if shape[0] == 0 or shape[1] == 0:
+            codes = np.zeros(shape, dtype=dtype)
+        elif mmap:
+            codes = np.memmap(codes_file, dtype=dtype, mode="r", shape=shape)
+        else:
+            codes = np.fromfile(codes_file, dtype=dtype).reshape(shape)
+        dictionary = np.fromfile(os.path.join(directory, cls.dictionary_file), dtype=AlleleMatrix.dtype)
+
+        return cls(
+            index["samples"],
+            index["loci"],
+            codes,
+            dictionary,
+            np.array(index["dictionary_sizes"], dtype=np.int64),
+            index["id_column"],
+            index.get("missing_calls", {}),
+        )
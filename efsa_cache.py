@@ -0,0 +1,310 @@
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from typing import Dict, List, Optional
+
+from efsa_parser import PARSER_VERSION
+
+
+def fingerprint(filename: str, content: bool = True) -> list:
+    """size, modification time (ns) and, if content, blake2b hash of a file"""
+    stat = os.stat(filename)
+    result = [stat.st_size, stat.st_mtime_ns, ""]
+    if content:
+        digest = hashlib.blake2b(digest_size=16)
+        with open(filename, "rb") as infile:
+            for chunk in iter(lambda: infile.read(1 << 20), b""):
+                digest.update(chunk)
+        result[2] = digest.hexdigest()
+
+    return result
+
+
+# blocks read from each fastq file to fingerprint it
+FINGERPRINT_BLOCKS = 16
+FINGERPRINT_BLOCK_SIZE = 64 * 1024
+
+
+def sampled_fingerprint(
+    filename: str, blocks: int = FINGERPRINT_BLOCKS, block_size: int = FINGERPRINT_BLOCK_SIZE
+) -> str:
+    """
+    blake2b hash of the size of a file and of blocks evenly spread over it (the whole file when it is
+    not larger than the blocks), so that fingerprinting a fastq file only reads about 1 MB of it
+    """
+    size = os.path.getsize(filename)
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(filename, "rb") as infile:
+        if size <= blocks * block_size:
+            digest.update(infile.read())
+        else:
+            step = (size - block_size) // (blocks - 1)
+            for i in range(blocks):
+                infile.seek(i * step)
+                digest.update(infile.read(block_size))
+
+    return digest.hexdigest()
+
+
+class AnalysisCache:
+    """
+    persistent cache of the outputs of the EFSA pipeline, so that reads that were already analysed
+    (e.g. an isolate submitted again in another run, under the same or another name) are not analysed again
+
+    Entries are keyed by the sampled fingerprints of the fastq files of the sample (in the order of their
+    names) and by the workflow (species and content of the workflow and nextflow config files). Each entry
+    is a folder <key>/ with a copy of the output files of the sample and an entry.json.
+    """
+
+    output_files = ["_parseresults.json", "_hashed_results.tsv", "_logging.json"]
+    entry_file = "entry.json"
+
+    def __init__(self, directory: str, workflow_files: List[str], species: str) -> None:
+
+        self.directory = directory
+        digest = hashlib.blake2b(species.encode(), digest_size=16)
+        for filename in workflow_files:
+            if os.path.exists(filename):
+                with open(filename, "rb") as infile:
+                    digest.update(infile.read())
+        self.workflow = digest.hexdigest()
+
+    def key(self, fastq_files: List[str]) -> str:
+        digest = hashlib.blake2b(self.workflow.encode(), digest_size=16)
+        for filename in sorted(fastq_files, key=os.path.basename):
+            digest.update(sampled_fingerprint(filename).encode())
+
+        return digest.hexdigest()
+
+    def lookup(self, key: str) -> Optional[dict]:
+        entry_file = os.path.join(self.directory, key, self.entry_file)
+        if not os.path.exists(entry_file):
+            return None
+        with open(entry_file) as infile:
+            return json.load(infile)
+
+    @classmethod
+    def find_output(cls, sample_dir: str) -> str:
+        """output folder of the EFSA pipeline in a sample directory (empty if there is none or several)"""
+        outputs = [
+            os.path.join(sample_dir, folder)
+            for folder in sorted(os.listdir(sample_dir))
+            if not folder.startswith("work")
+            and os.path.exists(os.path.join(sample_dir, folder, cls.output_files[0]))
+        ]
+
+        return outputs[0] if len(outputs) == 1 else ""
+
+    def store(self, key: str, sample_dir: str, sample: str) -> bool:
+        """copy the outputs of a successful analysis to the cache (False if it has no complete output)"""
+
+        output = self.find_output(sample_dir)
+        if output == "" or not os.path.exists(os.path.join(output, self.output_files[1])):
+            return False
+        if self.lookup(key) is not None:
+            return True
+        staging = os.path.join(self.directory, key + ".tmp" + str(os.getpid()))
+        os.makedirs(staging, exist_ok=True)
+        files = []
+        for filename in self.output_files:
+            if os.path.exists(os.path.join(output, filename)):
+                shutil.copyfile(os.path.join(output, filename), os.path.join(staging, filename))
+                files.append(filename)
+        with open(os.path.join(staging, self.entry_file), "w") as outfile:
+            json.dump(
+                {
+                    "sample": sample,
+                    "output": os.path.basename(output),
+                    "files": files,
+                    "created": str(datetime.datetime.now()),
+                },
+                outfile,
+            )
+        try:
+            os.rename(staging, os.path.join(self.directory, key))
+        except OSError:
+            # stored at the same time by another run
+            shutil.rmtree(staging, ignore_errors=True)
+
+        return True
+
+    def restore(self, key: str, sample_dir: str, sample: str) -> bool:
+        """
+        copy the cached outputs to a new output folder of the sample directory, with the name of the sample
+        in the allele profile replaced by the new one (False if the key is not cached)
+        """
+
+        entry = self.lookup(key)
+        if entry is None:
+            return False
+        output = os.path.join(sample_dir, entry["output"])
+        os.makedirs(output, exist_ok=True)
+        for filename in entry["files"]:
+            source = os.path.join(self.directory, key, filename)
+            if filename == "_hashed_results.tsv" and entry["sample"] != sample:
+                with open(source) as infile, open(os.path.join(output, filename), "w") as outfile:
+                    outfile.write(infile.readline())
+                    for line in infile:
+                        name, separator, rest = line.partition("\t")
+                        if name == entry["sample"] or name.startswith(entry["sample"] + "_"):
+                            name = sample + name[len(entry["sample"]) :]
+                        outfile.write(name + separator + rest)
+            else:
+                shutil.copyfile(source, os.path.join(output, filename))
+
+        return True
+
+
+class ResultCache:
+    """
+    cache of the parsed results of the samples of a run, so that regenerating the reports only parses
+    the samples whose result files changed
+
+    Each entry holds the report records extracted from the _parseresults.json of a sample ("reports").
+    Allele profiles are not cached: they are already kept in the allele matrix of the run and reading
+    a _hashed_results.tsv again costs about as much as reading a cached copy of it. An entry is used
+    when the file has the same size and modification time as when it was cached, or else the same
+    content hash. Entries are kept in <run>/result_cache/ (one json file each) with an index. The cache
+    is dropped when the parser version changes, and the least recently used entries are removed above
+    max_bytes.
+    """
+
+    directory_name = "result_cache"
+    index_file = "index.json"
+    max_bytes = 2 * 1024**3
+
+    def __init__(self, run_directory: str, max_bytes: Optional[int] = None) -> None:
+
+        self.directory = os.path.join(run_directory, self.directory_name)
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        self.entries = {}
+        self.invalidated = False
+        self.hits = 0
+        self.misses = 0
+        index_file = os.path.join(self.directory, self.index_file)
+        if os.path.exists(index_file):
+            with open(index_file) as infile:
+                index = json.load(infile)
+            if index.get("version") == self.version():
+                self.entries = index["entries"]
+            else:
+                self.invalidated = True
+
+    @staticmethod
+    def version() -> dict:
+        return {"parser": PARSER_VERSION}
+
+    @staticmethod
+    def entry_key(sample: str, kind: str) -> str:
+        return sample + "." + kind
+
+    def entry_file(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".json")
+
+    def valid(self, entry: dict, filename: str, stat: Optional[list] = None) -> bool:
+        """
+        whether the cached entry was extracted from a file with the content of filename (stat: size and
+        modification time of the file, if already known)
+        """
+        if stat is None:
+            if not os.path.exists(filename):
+                return False
+            stat = fingerprint(filename, content=False)[:2]
+        if stat == entry["file"][:2]:
+            return True
+        current = fingerprint(filename)
+        if current[0] == entry["file"][0] and current[2] == entry["file"][2]:
+            entry["file"] = current
+            return True
+
+        return False
+
+    def get(self, sample: str, kind: str, filename: str, stat: Optional[list] = None) -> Optional[dict]:
+        """cached data of the file of a sample, None if it is not cached or the file changed"""
+
+        key = self.entry_key(sample, kind)
+        entry = self.entries.get(key)
+        if entry is None or not self.valid(entry, filename, stat):
+            self.misses += 1
+            return None
+        try:
+            with open(self.entry_file(key)) as infile:
+                data = json.load(infile)
+        except (FileNotFoundError, ValueError):
+            self.misses += 1
+            return None
+        entry["used"] = time.time()
+        self.hits += 1
+
+        return data
+
+    def contains(self, sample: str, kind: str, filename: str, stat: Optional[list] = None) -> bool:
+        """whether the file of a sample is cached and did not change (not counted as a hit or a miss)"""
+        entry = self.entries.get(self.entry_key(sample, kind))
+        return entry is not None and os.path.exists(self.entry_file(self.entry_key(sample, kind))) and self.valid(
+            entry, filename, stat
+        )
+
+    def put(self, sample: str, kind: str, filename: str, data: dict):
+        """cache the data extracted from the file of a sample"""
+
+        if self.invalidated:
+            self.purge()
+        os.makedirs(self.directory, exist_ok=True)
+        key = self.entry_key(sample, kind)
+        with open(self.entry_file(key), "w") as outfile:
+            json.dump(data, outfile)
+        self.entries[key] = {
+            "file": fingerprint(filename),
+            "used": time.time(),
+            "bytes": os.path.getsize(self.entry_file(key)),
+        }
+
+    def size(self) -> int:
+        return sum(entry["bytes"] for entry in self.entries.values())
+
+    def evict(self):
+        """remove the least recently used entries until the cache fits in max_bytes"""
+        size = self.size()
+        for key in sorted(self.entries, key=lambda key: self.entries[key]["used"]):
+            if size <= self.max_bytes:
+                break
+            size -= self.entries[key]["bytes"]
+            del self.entries[key]
+            if os.path.exists(self.entry_file(key)):
+                os.remove(self.entry_file(key))
+
+    def save(self):
+        """write the index (dropping the entries of an older version and the ones above max_bytes)"""
+
+        if self.invalidated:
+            self.purge()
+        if not self.entries:
+            return
+        self.evict()
+        with open(os.path.join(self.directory, self.index_file), "w") as outfile:
+            json.dump({"version": self.version(), "entries": self.entries}, outfile)
+
+    def purge(self):
+        """remove all the entries"""
+
+        self.entries = {}
+        if os.path.exists(self.directory):
+            for filename in os.listdir(self.directory):
+                if filename.endswith(".json"):
+                    os.remove(os.path.join(self.directory, filename))
+        self.invalidated = False
+
+    def summary(self) -> Dict[str, int]:
+        """number of entries of each kind"""
+        kinds = {}
+        for key in self.entries:
+            kind = key.rsplit(".", 1)[1]
+            kinds[kind] = kinds.get(kind, 0) + 1
+
+        return kinds
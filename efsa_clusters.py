@@ -0,0 +1,175 @@
+import json
+import os
+
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from efsa_distances import DistanceMatrix
+
+
+class UnionFind:
+    def __init__(self, size: int) -> None:
+        self.parent = list(range(size))
+
+    def find(self, item: int) -> int:
+        while self.parent[item] != item:
+            self.parent[item] = self.parent[self.parent[item]]
+            item = self.parent[item]
+        return item
+
+    def union(self, item_a: int, item_b: int):
+        root_a = self.find(item_a)
+        root_b = self.find(item_b)
+        if root_a != root_b:
+            self.parent[max(root_a, root_b)] = min(root_a, root_b)
+
+
+def cluster_number(name: str) -> int:
+    return int(name.split("_")[-1])
+
+
+def threshold_links(
+    blocks: List[DistanceMatrix], threshold: int, start: int = 0, chunk_rows: int = 1024
+):
+    """
+    pairs of samples (positions in the order of the blocks) at a distance <= threshold, for the rows
+    from position start onwards. Each block holds its samples against all the samples up to it, so
+    every pair is found exactly once in the row of its most recent sample.
+    """
+    offset = 0
+    for block in blocks:
+        first_row = max(start - offset, 0)
+        for row in range(first_row, len(block.samples), chunk_rows):
+            chunk = np.asarray(block.values[row : row + chunk_rows])
+            rows, columns = np.nonzero(chunk <= threshold)
+            rows = rows + offset + row
+            keep = columns < rows
+            for item_a, item_b in zip(rows[keep].tolist(), columns[keep].tolist()):
+                yield item_a, item_b
+        offset += len(block.samples)
+
+
+class ClusterState:
+    """
+    single-linkage cluster assignment of all the samples of a run at several allele thresholds
+
+    Cluster names are kept across runs: a new sample joins the cluster of the samples it is linked
+    to, clusters of new samples only get the next free number and, when a new sample links several
+    existing clusters, they take the name of the oldest one and the merge is recorded. Samples not
+    linked to any other sample are reported as "singleton".
+    """
+
+    state_file = "clusters.json"
+    singleton = "singleton"
+
+    def __init__(
+        self,
+        samples: Optional[List[str]] = None,
+        labels: Optional[Dict[str, List[str]]] = None,
+        counters: Optional[Dict[str, int]] = None,
+        merges: Optional[List[dict]] = None,
+    ) -> None:
+
+        self.samples = samples if samples is not None else []
+        self.labels = labels if labels is not None else {}
+        self.counters = counters if counters is not None else {}
+        self.merges = merges if merges is not None else []
+
+    @classmethod
+    def exists(cls, directory: str) -> bool:
+        return os.path.exists(os.path.join(directory, cls.state_file))
+
+    @classmethod
+    def load(cls, directory: str) -> "ClusterState":
+        with open(os.path.join(directory, cls.state_file)) as infile:
+            state = json.load(infile)
+
+        return cls(state["samples"], state["labels"], state["counters"], state["merges"])
+
+    def save(self, directory: str):
+        with open(os.path.join(directory, self.state_file), "w") as outfile:
+            json.dump(
+                {
+                    "samples": self.samples,
+                    "labels": self.labels,
+                    "counters": self.counters,
+                    "merges": self.merges,
+                },
+                outfile,
+            )
+
+    @staticmethod
+    def column(threshold) -> str:
+        return "Cluster_" + str(threshold)
+
+    def update(
+        self, blocks: List[DistanceMatrix], thresholds: List[int], run_name: str
+    ) -> "ClusterState":
+        """cluster assignment of all the samples of the blocks, extending this one"""
+
+        samples = [sample for block in blocks for sample in block.samples]
+        extends = self.samples == samples[: len(self.samples)]
+        state = ClusterState(samples, {}, {}, [merge for merge in self.merges])
+        for threshold in thresholds:
+            key = str(threshold)
+            if extends and key in self.labels:
+                start = len(self.samples)
+                previous_labels = self.labels[key]
+                counter = self.counters[key]
+            else:
+                start = 0
+                previous_labels = []
+                counter = 0
+
+            groups = UnionFind(len(samples))
+            first_member = {}
+            for item, label in enumerate(previous_labels):
+                if label != self.singleton:
+                    groups.union(item, first_member.setdefault(label, item))
+            for item_a, item_b in threshold_links(blocks, threshold, start):
+                groups.union(item_a, item_b)
+
+            members = {}
+            for item in range(len(samples)):
+                members.setdefault(groups.find(item), []).append(item)
+            labels = [self.singleton] * len(samples)
+            for root in sorted(members.keys()):
+                items = members[root]
+                names = sorted(
+                    set(
+                        previous_labels[item]
+                        for item in items
+                        if item < start and previous_labels[item] != self.singleton
+                    ),
+                    key=cluster_number,
+                )
+                if names:
+                    name = names[0]
+                    if len(names) > 1:
+                        state.merges.append(
+                            {
+                                "run": run_name,
+                                "threshold": threshold,
+                                "merged": names[1:],
+                                "into": name,
+                            }
+                        )
+                elif len(items) > 1:
+                    counter += 1
+                    name = "cluster_" + str(counter)
+                else:
+                    continue
+                for item in items:
+                    labels[item] = name
+            state.labels[key] = labels
+            state.counters[key] = counter
+
+        return state
+
+    def to_dict(self) -> Dict[str, Dict[str, str]]:
+        """cluster column -> sample -> cluster name"""
+        return {
+            self.column(threshold): dict(zip(self.samples, labels))
+            for threshold, labels in self.labels.items()
+        }
@@ -0,0 +1,282 @@
+import concurrent.futures
+import json
+import os
+
+from typing import List, Optional, Union
+
+import numpy as np
+
+from efsa_alleles import MISSING, AlleleMatrix, EncodedAlleleMatrix
+
+
+# number of cells (rows x columns x loci) compared at once by each worker
+TILE_CELLS = 2**24
+# bytes of the square matrix written (or exported) at once
+CHUNK_BYTES = 2**26
+
+
+def tile_size(n_loci: int) -> int:
+    """rows/columns of a square tile so that one comparison tile takes about TILE_CELLS bytes"""
+    return max(1, int((TILE_CELLS / max(n_loci, 1)) ** 0.5))
+
+
+def count_differences(block_a: np.ndarray, block_b: np.ndarray) -> np.ndarray:
+    """
+    number of loci with different alleles between every row of block_a and every row of block_b,
+    loci missing in either profile are not counted
+    """
+    differences = block_a[:, None, :] != block_b[None, :, :]
+    differences &= (block_a != MISSING)[:, None, :]
+    differences &= (block_b != MISSING)[None, :, :]
+
+    return differences.sum(axis=2)
+
+
+def fill_distances(
+    values_a: np.ndarray,
+    values_b: np.ndarray,
+    out: np.ndarray,
+    threads: int = 1,
+    symmetric: bool = False,
+):
+    """
+    fill out (len(values_a) x len(values_b)) with the allele distances between the rows of values_a
+    and values_b, tile by tile and across threads (numpy releases the GIL while comparing).
+    When symmetric (values_a is values_b) only the upper tiles are computed and mirrored.
+    """
+    size = tile_size(values_a.shape[1])
+    tiles = []
+    for row in range(0, values_a.shape[0], size):
+        for column in range(row if symmetric else 0, values_b.shape[0], size):
+            tiles.append((row, column))
+
+    def compute_tile(tile):
+        row, column = tile
+        block_a = np.asarray(values_a[row : row + size])
+        block_b = np.asarray(values_b[column : column + size])
+        distances = count_differences(block_a, block_b)
+        out[row : row + size, column : column + size] = distances
+        if symmetric and row != column:
+            out[column : column + size, row : row + size] = distances.T
+
+    if threads > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(compute_tile, tiles))
+    else:
+        for tile in tiles:
+            compute_tile(tile)
+
+
+class DistanceMatrix:
+    """
+    samples x samples matrix of allele distances (number of loci called in both samples with different alleles)
+
+    Stored like the allele matrix: a raw little-endian unsigned integer file (distances.bin) plus a json
+    index with the sample names (distances.index.json), memory-mapped when loaded. A matrix can also be
+    a block of rows (samples) against a different list of columns, which is how each run keeps the
+    distances of its own samples against all the samples up to it. Parts of a loaded matrix can also be
+    read from its data file (read), so that the pages read are not kept mapped.
+    """
+
+    data_file = "distances.bin"
+    index_file = "distances.index.json"
+    format_version = 1
+
+    def __init__(
+        self,
+        samples: List[str],
+        values: np.ndarray,
+        columns: Optional[List[str]] = None,
+        data_path: Optional[str] = None,
+    ) -> None:
+
+        self.samples = list(samples)
+        self.columns = list(columns) if columns is not None else self.samples
+        if values.shape != (len(self.samples), len(self.columns)):
+            raise ValueError(
+                f"Distance matrix shape {values.shape} does not match {len(self.samples)} x {len(self.columns)} samples"
+            )
+        self.values = values
+        # data file the values are mapped from (None if they are in memory)
+        self.data_path = data_path
+
+    @staticmethod
+    def dtype_for(n_loci: int) -> np.dtype:
+        return np.dtype("<u2") if n_loci <= np.iinfo(np.uint16).max else np.dtype("<u4")
+
+    @classmethod
+    def exists(cls, directory: str) -> bool:
+        return os.path.exists(os.path.join(directory, cls.index_file)) and os.path.exists(
+            os.path.join(directory, cls.data_file)
+        )
+
+    @classmethod
+    def compute_block(
+        cls,
+        alleles: Union[AlleleMatrix, EncodedAlleleMatrix],
+        previous: List[Union[AlleleMatrix, EncodedAlleleMatrix]],
+        directory: str,
+        threads: int = 1,
+    ) -> "DistanceMatrix":
+        """
+        compute the distances of the samples of alleles against all the samples of previous (in order)
+        and against themselves, directly into directory: k x (N + k) cells instead of (N + k)^2.
+        The previous matrices are read block by block of rows. Dictionary-encoded matrices are compared
+        on their codes (the samples of alleles are translated into the dictionaries of each of them), so
+        they are never decoded.
+        """
+
+        encoded = alleles if isinstance(alleles, EncodedAlleleMatrix) else None
+        if encoded is not None:
+            alleles = encoded.decode()
+        dtype = cls.dtype_for(len(alleles.loci))
+        columns = []
+        for matrix in previous:
+            columns.extend(matrix.samples)
+        offset = len(columns)
+        columns.extend(alleles.samples)
+        cls.write_index(directory, alleles.samples, dtype, columns)
+        if len(alleles.samples) == 0:
+            open(os.path.join(directory, cls.data_file), "w").close()
+            return cls([], np.zeros((0, len(columns)), dtype=dtype), columns)
+        values = np.memmap(
+            os.path.join(directory, cls.data_file),
+            dtype=dtype,
+            mode="w+",
+            shape=(len(alleles.samples), len(columns)),
+        )
+        start = 0
+        for matrix in previous:
+            if isinstance(matrix, EncodedAlleleMatrix):
+                codes = matrix.translate(alleles.select_loci(matrix.loci))
+                for chunk in matrix.iter_code_chunks():
+                    end = start + len(chunk)
+                    fill_distances(codes, chunk, values[:, start:end], threads)
+                    start = end
+                continue
+            for chunk in matrix.iter_chunks():
+                chunk = chunk.select_loci(alleles.loci)
+                end = start + len(chunk.samples)
+                fill_distances(alleles.values, chunk.values, values[:, start:end], threads)
+                start = end
+        own = np.asarray(encoded.codes) if encoded is not None else alleles.values
+        fill_distances(own, own, values[:, offset:], threads, symmetric=True)
+        values.flush()
+
+        return cls(alleles.samples, values, columns)
+
+    @classmethod
+    def write_index(
+        cls,
+        directory: str,
+        samples: List[str],
+        dtype: np.dtype,
+        columns: Optional[List[str]] = None,
+    ):
+        index = {
+            "format_version": cls.format_version,
+            "dtype": dtype.str,
+            "samples": samples,
+        }
+        if columns is not None:
+            index["columns"] = columns
+        with open(os.path.join(directory, cls.index_file), "w") as outfile:
+            json.dump(index, outfile)
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True) -> "DistanceMatrix":
+
+        with open(os.path.join(directory, cls.index_file)) as infile:
+            index = json.load(infile)
+
+        dtype = np.dtype(index["dtype"])
+        columns = index.get("columns", index["samples"])
+        shape = (len(index["samples"]), len(columns))
+        data_file = os.path.join(directory, cls.data_file)
+        if shape[0] == 0 or shape[1] == 0:
+            values = np.zeros(shape, dtype=dtype)
+        elif mmap:
+            values = np.memmap(data_file, dtype=dtype, mode="r", shape=shape)
+        else:
+            values = np.fromfile(data_file, dtype=dtype).reshape(shape)
+
+        return cls(index["samples"], values, columns, data_file if mmap and values.size else None)
+
+    def read(self, rows: slice, columns: slice) -> np.ndarray:
+        """
+        values[rows, columns] read into memory, from the data file when the matrix is mapped from one
+        (whole rows at once, parts of rows one by one) instead of through the mapping
+        """
+
+        start, stop, _ = rows.indices(len(self.samples))
+        first, last, _ = columns.indices(len(self.columns))
+        if self.data_path is None:
+            return np.array(self.values[start:stop, first:last])
+        dtype = self.values.dtype
+        width = len(self.columns)
+        shape = (max(stop - start, 0), max(last - first, 0))
+        with open(self.data_path, "rb") as infile:
+            if shape[1] == width:
+                infile.seek(start * width * dtype.itemsize)
+                return np.frombuffer(infile.read(shape[0] * width * dtype.itemsize), dtype=dtype).reshape(shape)
+            values = np.empty(shape, dtype=dtype)
+            for i in range(shape[0]):
+                infile.seek(((start + i) * width + first) * dtype.itemsize)
+                values[i] = np.frombuffer(infile.read(shape[1] * dtype.itemsize), dtype=dtype)
+
+        return values
+
+    @classmethod
+    def assemble(
+        cls, blocks: List["DistanceMatrix"], directory: str, chunk_bytes: int = CHUNK_BYTES
+    ) -> "DistanceMatrix":
+        """
+        write the square matrix of all the samples from the blocks of consecutive runs, block of rows by
+        block of rows (about chunk_bytes each): the rows of a sample are its row in its own block followed
+        by its column in each of the later blocks, and each block of rows is written after the previous one,
+        so neither the square matrix nor the blocks are mapped into memory
+        """
+
+        samples = []
+        for block in blocks:
+            if block.columns != samples + block.samples:
+                raise ValueError("Distance blocks do not match the order of the samples")
+            samples.extend(block.samples)
+        dtype = np.dtype("<u2")
+        if any(block.values.dtype != dtype for block in blocks):
+            dtype = np.dtype("<u4")
+        cls.write_index(directory, samples, dtype)
+        data_file = os.path.join(directory, cls.data_file)
+        if len(samples) == 0:
+            open(data_file, "w").close()
+            return cls([], np.zeros((0, 0), dtype=dtype))
+        chunk_rows = max(1, chunk_bytes // (len(samples) * dtype.itemsize))
+        with open(data_file, "wb") as outfile:
+            start = 0
+            for i, block in enumerate(blocks):
+                end = start + len(block.samples)
+                for row in range(0, len(block.samples), chunk_rows):
+                    stop = min(row + chunk_rows, len(block.samples))
+                    chunk = np.empty((stop - row, len(samples)), dtype=dtype)
+                    chunk[:, :end] = block.read(slice(row, stop), slice(None))
+                    column = end
+                    for later in blocks[i + 1 :]:
+                        chunk[:, column : column + len(later.samples)] = later.read(
+                            slice(None), slice(start + row, start + stop)
+                        ).T
+                        column += len(later.samples)
+                    chunk.tofile(outfile)
+                start = end
+
+        return cls.load(directory)
+
+    def to_tsv(self, filename: str):
+        """export the matrix as a square tsv (first column with the sample names)"""
+
+        chunk_rows = max(1, CHUNK_BYTES // max(1, len(self.columns) * self.values.dtype.itemsize))
+        with open(filename, "w") as outfile:
+            outfile.write("\t".join(["dists"] + self.columns) + "\n")
+            for row in range(0, len(self.samples), chunk_rows):
+                chunk = self.read(slice(row, row + chunk_rows), slice(None))
+                for sample, values in zip(self.samples[row : row + chunk_rows], chunk.tolist()):
+                    outfile.write(sample + "\t" + "\t".join(map(str, values)) + "\n")
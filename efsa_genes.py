@@ -0,0 +1,280 @@
+import json
+import os
+
+from typing import Dict, List, Optional, Set
+
+import numpy as np
+import pandas as pd
+
+
+# long tables with one gene (or variant) per row: column with the gene and columns describing the gene
+GENE_TABLES = {
+    "amr": ("key", ["Gene", "phenotypes", "ref_database", "type"]),
+    "pathotypes": ("GeneName", []),
+}
+# column with the gene of each variant: names the rows whose variant column is missing or empty, and the
+# samples carrying a variant are also found by the name of its gene
+GENE_NAME_COLUMNS = {"amr": "Gene"}
+# text columns of the long tables that repeat the same few values over and over
+CATEGORICAL_COLUMNS = ["Analysis_ID", "key", "Gene", "GeneName", "phenotypes", "ref_database", "type"]
+
+
+def as_categoricals(df: pd.DataFrame) -> pd.DataFrame:
+    """long table with its repeated text columns as categoricals (integer codes plus each distinct value once)"""
+    for column in CATEGORICAL_COLUMNS:
+        if column in df.columns:
+            df[column] = df[column].astype("category")
+
+    return df
+
+
+def split_values(value) -> List[str]:
+    """distinct values of a cell of a long table (phenotypes are listed as "a, b")"""
+    if pd.isna(value) or str(value) in ["", "-"]:
+        return []
+    return [item.strip() for item in str(value).split(",") if item.strip()]
+
+
+class GenePresence:
+    """
+    sparse samples x genes presence matrix of a long table (AMR genes or pathotype genes) with the
+    description of each gene (e.g. its phenotypes)
+
+    AMR rows are told apart by their variant (the key column, e.g. 23S_356_a for a point mutation of 23S),
+    with the gene of the variant kept in its description, so the mutations of a gene are not merged.
+
+    The genes found in each sample are kept as gene numbers, those of sample i in
+    numbers[offsets[i]:offsets[i + 1]], and the name and description of each gene are stored once.
+    Genes keep their number when samples are appended (new genes are numbered after the known ones),
+    so the matrix of a chain of runs is the matrix of each run appended in order. On disk it is kept
+    as <table>.genes.bin (gene numbers, uint32) and <table>.genes.index.json (samples, offsets, genes
+    and their descriptions).
+    """
+
+    dtype = np.dtype("<u4")
+    format_version = 2
+
+    def __init__(
+        self,
+        table: str,
+        samples: List[str],
+        offsets: np.ndarray,
+        numbers: np.ndarray,
+        genes: List[str],
+        descriptions: Dict[str, Dict[str, List[str]]],
+    ) -> None:
+
+        if len(offsets) != len(samples) + 1 or offsets[-1] != len(numbers):
+            raise ValueError(f"Gene offsets do not match {len(samples)} samples x {len(numbers)} genes found")
+        self.table = table
+        self.samples = list(samples)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.numbers = np.asarray(numbers, dtype=self.dtype)
+        self.genes = list(genes)
+        # gene -> description column -> distinct values
+        self.descriptions = descriptions
+
+    def __len__(self):
+        return len(self.samples)
+
+    @classmethod
+    def data_file(cls, table: str) -> str:
+        return table + ".genes.bin"
+
+    @classmethod
+    def index_file(cls, table: str) -> str:
+        return table + ".genes.index.json"
+
+    @classmethod
+    def empty(cls, table: str, samples: Optional[List[str]] = None) -> "GenePresence":
+        samples = samples if samples is not None else []
+        return cls(table, samples, np.zeros(len(samples) + 1, dtype=np.int64), np.zeros(0), [], {})
+
+    @classmethod
+    def from_dataframe(
+        cls, table: str, df: pd.DataFrame, samples: Optional[List[str]] = None
+    ) -> "GenePresence":
+        """
+        presence matrix of a long table (amr or pathotypes) for the given samples (in that order, by
+        default the ones of the table); samples of the table that are not in the list are added after them
+        """
+
+        gene_column, description_columns = GENE_TABLES[table]
+        samples = [str(sample) for sample in samples] if samples is not None else []
+        name_column = GENE_NAME_COLUMNS.get(table)
+        if name_column in df.columns:
+            names = df[name_column].where(df[name_column].astype(str) != "-")
+            if gene_column in df.columns:
+                keys = df[gene_column].where(~df[gene_column].astype(str).isin(["", "-"]))
+                names = keys.astype(object).fillna(names.astype(object))
+            df = df.assign(**{gene_column: names})
+        if df.empty or gene_column not in df.columns or "Analysis_ID" not in df.columns:
+            return cls.empty(table, samples)
+        df = df[df[gene_column].notna()]
+        known = set(samples)
+        for sample in pd.unique(df["Analysis_ID"].astype(str)).tolist():
+            if sample not in known:
+                samples.append(sample)
+                known.add(sample)
+
+        genes = pd.Categorical(df[gene_column].astype(str))
+        rows = pd.Categorical(df["Analysis_ID"].astype(str), categories=samples).codes.astype(np.int64)
+        n_genes = len(genes.categories)
+        pairs = np.unique(rows * n_genes + genes.codes)
+        offsets = np.searchsorted(pairs // n_genes if n_genes else pairs, np.arange(len(samples) + 1))
+
+        descriptions = {gene: {} for gene in genes.categories}
+        for column in description_columns:
+            if column not in df.columns:
+                continue
+            for gene, value in zip(genes.astype(str), df[column].tolist()):
+                values = descriptions[gene].setdefault(column, [])
+                values.extend(item for item in split_values(value) if item not in values)
+
+        return cls(
+            table,
+            samples,
+            offsets,
+            pairs % n_genes if n_genes else pairs,
+            genes.categories.tolist(),
+            descriptions,
+        )
+
+    def append(self, other: "GenePresence") -> "GenePresence":
+        """return a new matrix with the samples of other after the ones of this one"""
+
+        number = {gene: i for i, gene in enumerate(self.genes)}
+        genes = self.genes + [gene for gene in other.genes if gene not in number]
+        number = {gene: i for i, gene in enumerate(genes)}
+        renumber = np.array([number[gene] for gene in other.genes], dtype=self.dtype)
+        descriptions = {
+            gene: {column: list(values) for column, values in description.items()}
+            for gene, description in self.descriptions.items()
+        }
+        for gene, description in other.descriptions.items():
+            for column, values in description.items():
+                known = descriptions.setdefault(gene, {}).setdefault(column, [])
+                known.extend(value for value in values if value not in known)
+
+        return GenePresence(
+            self.table,
+            self.samples + other.samples,
+            np.concatenate([self.offsets, other.offsets[1:] + self.offsets[-1]]),
+            np.concatenate([self.numbers, renumber[other.numbers]]),
+            genes,
+            descriptions,
+        )
+
+    def sample_rows(self) -> np.ndarray:
+        """sample (row) of each gene found"""
+        return np.repeat(np.arange(len(self.samples)), np.diff(self.offsets))
+
+    def matching(self, name: str) -> List[int]:
+        """numbers of the genes (or variants) named name, or whose gene is named name"""
+
+        name_column = GENE_NAME_COLUMNS.get(self.table, "")
+
+        return [
+            number
+            for number, gene in enumerate(self.genes)
+            if gene == name or name in self.describe(gene, name_column)
+        ]
+
+    def samples_with(self, genes: List[str], all_genes: bool = False) -> List[str]:
+        """samples carrying any of the genes or variants (all of them with all_genes)"""
+
+        rows = self.sample_rows()
+        selected = np.full(len(self.samples), all_genes, dtype=bool)
+        for name in set(genes):
+            carrying = np.zeros(len(self.samples), dtype=bool)
+            carrying[rows[np.isin(self.numbers, self.matching(name))]] = True
+            selected = selected & carrying if all_genes else selected | carrying
+
+        return [sample for sample, hit in zip(self.samples, selected.tolist()) if hit and genes]
+
+    def genes_of(self, sample: str) -> List[str]:
+        row = self.samples.index(sample)
+        return sorted(self.genes[number] for number in self.numbers[self.offsets[row] : self.offsets[row + 1]])
+
+    def describe(self, gene: str, column: str = "phenotypes") -> List[str]:
+        """values of a description column of a gene (e.g. the phenotypes of an AMR gene)"""
+        return self.descriptions.get(gene, {}).get(column, [])
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """presence table: one row per sample and one column per gene (1 if found in the sample, 0 if not)"""
+
+        values = np.zeros((len(self.samples), len(self.genes)), dtype=np.uint8)
+        values[self.sample_rows(), self.numbers.astype(np.int64)] = 1
+        order = sorted(range(len(self.genes)), key=lambda number: self.genes[number])
+        df = pd.DataFrame(values[:, order], columns=[self.genes[number] for number in order])
+        df.insert(0, "Analysis_ID", self.samples)
+
+        return df
+
+    def genes_dataframe(self) -> pd.DataFrame:
+        """one row per gene with its description and the number of samples carrying it"""
+
+        gene_column, description_columns = GENE_TABLES[self.table]
+        counts = np.bincount(self.numbers.astype(np.int64), minlength=len(self.genes))
+        rows = []
+        for number, gene in sorted(enumerate(self.genes), key=lambda item: item[1]):
+            row = {gene_column: gene}
+            for column in description_columns:
+                row[column] = ", ".join(self.describe(gene, column)) or "-"
+            row["samples"] = int(counts[number])
+            rows.append(row)
+
+        return pd.DataFrame(rows, columns=[gene_column] + description_columns + ["samples"])
+
+    @classmethod
+    def exists(cls, directory: str, table: str) -> bool:
+        """whether directory has the matrix of the table in the current format"""
+
+        if not os.path.exists(os.path.join(directory, cls.index_file(table))) or not os.path.exists(
+            os.path.join(directory, cls.data_file(table))
+        ):
+            return False
+        with open(os.path.join(directory, cls.index_file(table))) as infile:
+            return json.load(infile).get("format_version") == cls.format_version
+
+    def save(self, directory: str):
+        """write the gene numbers and the index to directory"""
+
+        self.numbers.tofile(os.path.join(directory, self.data_file(self.table)))
+        with open(os.path.join(directory, self.index_file(self.table)), "w") as outfile:
+            json.dump(
+                {
+                    "format_version": self.format_version,
+                    "dtype": self.dtype.str,
+                    "samples": self.samples,
+                    "offsets": self.offsets.tolist(),
+                    "genes": self.genes,
+                    "descriptions": self.descriptions,
+                },
+                outfile,
+            )
+
+    @classmethod
+    def load(cls, directory: str, table: str) -> "GenePresence":
+        with open(os.path.join(directory, cls.index_file(table))) as infile:
+            index = json.load(infile)
+        numbers = np.fromfile(os.path.join(directory, cls.data_file(table)), dtype=cls.dtype)
+
+        return cls(
+            table, index["samples"], np.array(index["offsets"]), numbers, index["genes"], index["descriptions"]
+        )
+
+
+def samples_with_genes(presence: Dict[str, GenePresence], genes: List[str], all_genes: bool = False) -> Set[str]:
+    """
+    samples carrying any of the genes (or variants) in any of the presence matrices (e.g. the AMR and pathotype
+    matrices of a run), or all of them with all_genes (each one in either matrix)
+    """
+
+    carriers = [
+        set(sample for matrix in presence.values() for sample in matrix.samples_with([gene])) for gene in set(genes)
+    ]
+    if not carriers:
+        return set()
+
+    return set.intersection(*carriers) if all_genes else set.union(*carriers)
@@ -0,0 +1,58 @@
+import datetime
+import json
+import os
+import threading
+
+from typing import Dict, List, Optional
+
+
+class RunLedger:
+    """
+    state of each sample of a run, kept in <run>/run_state.json so that an interrupted run can be resumed
+
+    A sample is "staged" once all its fastq files are in its directory, "running" while the EFSA
+    pipeline is analysing it and "succeeded" or "failed" (with the exit code) when the pipeline finished.
+    The ledger is written (atomically) at every change, so it reflects the run up to the moment it was
+    interrupted.
+    """
+
+    ledger_file = "run_state.json"
+    STAGED = "staged"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+
+    def __init__(self, run_directory: str) -> None:
+
+        self.filename = os.path.join(run_directory, self.ledger_file)
+        self.samples: Dict[str, dict] = {}
+        self.lock = threading.Lock()
+        if os.path.exists(self.filename):
+            with open(self.filename) as infile:
+                self.samples = json.load(infile)["samples"]
+
+    def state(self, sample: str) -> str:
+        """state of a sample (empty if it was never staged)"""
+        return self.samples.get(sample, {}).get("state", "")
+
+    def update(self, samples: List[str], state: str, exit_code: Optional[int] = None):
+        with self.lock:
+            for sample in samples:
+                entry = self.samples.setdefault(sample, {"attempts": 0})
+                entry["state"] = state
+                entry["updated"] = str(datetime.datetime.now())
+                if state == self.RUNNING:
+                    entry["attempts"] += 1
+                if exit_code is not None:
+                    entry["exit_code"] = exit_code
+            self.save()
+
+    def finish(self, sample: str, exit_code: int):
+        """record the end of the analysis of a sample"""
+        self.update([sample], self.SUCCEEDED if exit_code == 0 else self.FAILED, exit_code)
+
+    def save(self):
+        staging = self.filename + ".tmp"
+        with open(staging, "w") as outfile:
+            json.dump({"samples": self.samples}, outfile, indent=4)
+        os.replace(staging, self.filename)
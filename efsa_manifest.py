@@ -0,0 +1,64 @@
+import os
+
+from typing import Dict, List, Optional
+
+
+class ResultManifest:
+    """
+    result files of the samples of a run, indexed in a single pass over the sample directories
+
+    Each sample directory is listed once with os.scandir and so is each of its EFSA output folders
+    (nextflow work folders and hidden folders are never entered). The size and modification time of
+    every result file found are kept, so that later stages neither list the directories again nor
+    stat the files. It is kept in memory for the run only: the result files can be rewritten in place
+    without their directories changing, so a saved manifest could not be trusted by a later run.
+    """
+
+    result_files = ["_parseresults.json", "_hashed_results.tsv", "_logging.json"]
+
+    def __init__(self, samples: Optional[Dict[str, Dict[str, Dict[str, list]]]] = None) -> None:
+
+        # sample directory -> output folder -> result file -> [size, mtime_ns]
+        self.samples = samples if samples is not None else {}
+
+    @classmethod
+    def scan_sample(cls, sample_dir: str) -> Dict[str, Dict[str, list]]:
+        outputs = {}
+        try:
+            with os.scandir(sample_dir) as entries:
+                folders = [
+                    entry.name
+                    for entry in entries
+                    if entry.is_dir() and not entry.name.startswith(("work", "."))
+                ]
+        except (FileNotFoundError, NotADirectoryError):
+            return outputs
+        for folder in sorted(folders):
+            files = {}
+            with os.scandir(os.path.join(sample_dir, folder)) as entries:
+                for entry in entries:
+                    if entry.name in cls.result_files and entry.is_file():
+                        stat = entry.stat()
+                        files[entry.name] = [stat.st_size, stat.st_mtime_ns]
+            if files:
+                outputs[folder] = files
+
+        return outputs
+
+    @classmethod
+    def scan(cls, sample_dirs: List[str]) -> "ResultManifest":
+        return cls({sample_dir: cls.scan_sample(sample_dir) for sample_dir in sample_dirs})
+
+    def files(self, sample_dir: str, filename: str) -> List[str]:
+        """paths of a result file in the output folders of a sample (as glob <sample_dir>/*/<filename>)"""
+        return [
+            os.path.join(sample_dir, folder, filename)
+            for folder, files in self.samples.get(sample_dir, {}).items()
+            if filename in files
+        ]
+
+    def stat(self, path: str) -> Optional[list]:
+        """[size, mtime_ns] of a result file found by files (None if it is not in the manifest)"""
+        folder_path, filename = os.path.split(path)
+        sample_dir, folder = os.path.split(folder_path)
+        return self.samples.get(sample_dir, {}).get(folder, {}).get(filename)
@@ -0,0 +1,115 @@
+import contextlib
+import cProfile
+import datetime
+import json
+import os
+import re
+import resource
+import threading
+import time
+
+from typing import Dict, Optional
+
+
+def reset_peak_rss() -> bool:
+    """reset the peak resident memory of the process (False if it is not supported, i.e. not on Linux)"""
+    try:
+        with open("/proc/self/clear_refs", "w") as outfile:
+            outfile.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb() -> float:
+    """peak resident memory of the process (since the last reset_peak_rss, where supported)"""
+    try:
+        with open("/proc/self/status") as infile:
+            return int(re.search(r"VmHWM:\s+(\d+)", infile.read()).group(1)) / 1024
+    except (OSError, AttributeError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def children_cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class RunMetrics:
+    """
+    wall time, cpu time and peak memory of the stages of a run and of each run of the EFSA pipeline,
+    together with counters (files and bytes staged, exit codes, rows written), written to
+    <run>/run_metrics.json. With profile, the stages marked as profiled are run under cProfile and
+    their statistics written to <run>/profiles/<stage>.prof (to be read with pstats or snakeviz).
+    """
+
+    metrics_file = "run_metrics.json"
+    profile_directory = "profiles"
+
+    def __init__(self, run_directory: str, profile: bool = False) -> None:
+
+        self.run_directory = run_directory
+        self.profile = profile
+        self.start = time.time()
+        self.stages: Dict[str, dict] = {}
+        self.pipeline_runs: Dict[str, dict] = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name: str, profiled: bool = False):
+        """measure the block as stage name (profiled with cProfile if requested for the run)"""
+
+        metrics = self.stages.setdefault(name, {})
+        profiler = cProfile.Profile() if self.profile and profiled else None
+        reset = reset_peak_rss()
+        children_cpu = children_cpu_seconds()
+        cpu = time.process_time()
+        wall = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield metrics
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            metrics["wall_seconds"] = round(time.perf_counter() - wall, 3)
+            metrics["cpu_seconds"] = round(time.process_time() - cpu, 3)
+            metrics["children_cpu_seconds"] = round(children_cpu_seconds() - children_cpu, 3)
+            metrics["peak_rss_mb"] = round(peak_rss_mb(), 1)
+            metrics["peak_rss_reset"] = reset
+            if profiler is not None:
+                os.makedirs(os.path.join(self.run_directory, self.profile_directory), exist_ok=True)
+                profile_file = os.path.join(self.run_directory, self.profile_directory, name + ".prof")
+                profiler.dump_stats(profile_file)
+                metrics["profile"] = os.path.relpath(profile_file, self.run_directory)
+
+    def count(self, stage: str, **counters):
+        """add counters (e.g. files, bytes or rows) to a stage"""
+        with self.lock:
+            self.stages.setdefault(stage, {}).update(counters)
+
+    def add_pipeline_run(
+        self, name: str, exit_code: int, wall_seconds: float, usage: Optional[resource.struct_rusage] = None
+    ):
+        """record a run of the EFSA pipeline (usage: resource usage of nextflow and its processes)"""
+
+        metrics = {"exit_code": exit_code, "wall_seconds": round(wall_seconds, 3)}
+        if usage is not None:
+            metrics["cpu_seconds"] = round(usage.ru_utime + usage.ru_stime, 3)
+            metrics["peak_rss_mb"] = round(usage.ru_maxrss / 1024, 1)
+        with self.lock:
+            self.pipeline_runs[name] = metrics
+
+    def save(self, **info):
+        """write run_metrics.json (info: extra fields, e.g. the version or the command line)"""
+
+        with self.lock:
+            metrics = dict(
+                info,
+                start=str(datetime.datetime.fromtimestamp(self.start)),
+                wall_seconds=round(time.time() - self.start, 3),
+                stages=self.stages,
+                pipeline_runs=self.pipeline_runs,
+            )
+        with open(os.path.join(self.run_directory, self.metrics_file), "w") as outfile:
+            json.dump(metrics, outfile, indent=4)
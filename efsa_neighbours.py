@@ -0,0 +1,244 @@
+import json
+import os
+
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from efsa_alleles import MISSING, AlleleMatrix, EncodedAlleleMatrix
+from efsa_distances import count_differences
+
+
+# loci per block of the neighbour index
+BLOCK_LOCI = 256
+
+
+class NeighbourIndex:
+    """
+    locus-blocked copy of the allele codes of a partition, for nearest neighbour queries
+
+    The allele codes of the dictionary-encoded matrix of the partition (see EncodedAlleleMatrix) are stored
+    as consecutive blocks of BLOCK_LOCI loci for all the samples (neighbours.bin, n_blocks x samples x
+    BLOCK_LOCI codes, the last block padded with MISSING) plus the dictionaries (neighbours.dictionary.bin)
+    and a json index with the sample and locus names and the code type (neighbours.index.json). Each block
+    is contiguous on disk, so a query reads the first block of every sample and then only the blocks of the
+    samples that can still be among the nearest. Queries are translated into the dictionaries of the index.
+    """
+
+    data_file = "neighbours.bin"
+    dictionary_file = "neighbours.dictionary.bin"
+    index_file = "neighbours.index.json"
+    format_version = 2
+
+    def __init__(self, samples: List[str], encoding: EncodedAlleleMatrix, blocks: np.ndarray) -> None:
+
+        self.samples = list(samples)
+        # dictionaries of the codes (a matrix without samples)
+        self.encoding = encoding
+        self.blocks = blocks
+
+    @property
+    def loci(self) -> List[str]:
+        return self.encoding.loci
+
+    @property
+    def block_loci(self) -> int:
+        return self.blocks.shape[2]
+
+    @classmethod
+    def exists(cls, directory: str) -> bool:
+        """whether directory holds an index written by this version"""
+
+        if not all(
+            os.path.exists(os.path.join(directory, filename))
+            for filename in [cls.index_file, cls.data_file, cls.dictionary_file]
+        ):
+            return False
+        with open(os.path.join(directory, cls.index_file)) as infile:
+            return json.load(infile).get("format_version") == cls.format_version
+
+    @classmethod
+    def build(
+        cls,
+        alleles: Union[AlleleMatrix, EncodedAlleleMatrix],
+        directory: str,
+        block_loci: int = BLOCK_LOCI,
+        chunk_rows: int = 4096,
+    ) -> "NeighbourIndex":
+        """
+        write the index of the allele matrix to directory, reading its codes block by block of rows
+        (a matrix that is not dictionary-encoded, e.g. of a legacy run, is encoded first)
+        """
+
+        if not isinstance(alleles, EncodedAlleleMatrix):
+            alleles = EncodedAlleleMatrix.encode(alleles)
+        dtype = alleles.codes.dtype
+        n_blocks = max(1, -(-len(alleles.loci) // block_loci))
+        shape = (n_blocks, len(alleles.samples), block_loci)
+        np.ascontiguousarray(alleles.dictionary, dtype=AlleleMatrix.dtype).tofile(
+            os.path.join(directory, cls.dictionary_file)
+        )
+        with open(os.path.join(directory, cls.data_file), "wb") as outfile:
+            outfile.truncate(int(np.prod(shape)) * dtype.itemsize)
+            row = 0
+            for chunk in alleles.iter_code_chunks(chunk_rows):
+                padded = np.zeros((len(chunk), n_blocks * block_loci), dtype=dtype)
+                padded[:, : len(alleles.loci)] = chunk
+                for block in range(n_blocks):
+                    # rows of a chunk are contiguous within each block
+                    outfile.seek((block * shape[1] + row) * block_loci * dtype.itemsize)
+                    np.ascontiguousarray(padded[:, block * block_loci : (block + 1) * block_loci]).tofile(outfile)
+                row += len(chunk)
+        # the index is written last, so an interrupted build is not taken for a complete one
+        with open(os.path.join(directory, cls.index_file), "w") as outfile:
+            json.dump(
+                {
+                    "format_version": cls.format_version,
+                    "dtype": dtype.str,
+                    "block_loci": block_loci,
+                    "samples": alleles.samples,
+                    "loci": alleles.loci,
+                    "dictionary_sizes": alleles.dictionary_sizes.tolist(),
+                },
+                outfile,
+            )
+
+        return cls.load(directory)
+
+    @classmethod
+    def load(cls, directory: str) -> "NeighbourIndex":
+        """load the index, memory-mapped (read-only)"""
+
+        with open(os.path.join(directory, cls.index_file)) as infile:
+            index = json.load(infile)
+
+        dtype = np.dtype(index["dtype"])
+        n_blocks = max(1, -(-len(index["loci"]) // index["block_loci"]))
+        shape = (n_blocks, len(index["samples"]), index["block_loci"])
+        if len(index["samples"]) == 0:
+            blocks = np.zeros(shape, dtype=dtype)
+        else:
+            blocks = np.memmap(os.path.join(directory, cls.data_file), dtype=dtype, mode="r", shape=shape)
+        encoding = EncodedAlleleMatrix(
+            [],
+            index["loci"],
+            np.zeros((0, len(index["loci"])), dtype=dtype),
+            np.fromfile(os.path.join(directory, cls.dictionary_file), dtype=AlleleMatrix.dtype),
+            np.array(index["dictionary_sizes"], dtype=np.int64),
+        )
+
+        return cls(index["samples"], encoding, blocks)
+
+    def align(self, loci: List[str], profile: np.ndarray) -> np.ndarray:
+        """
+        profile (alleles of loci) as codes in the blocks of this index (loci it does not have are MISSING,
+        alleles that are not in its dictionaries match no sample)
+        """
+
+        alleles = dict(zip(loci, profile.tolist()))
+        values = np.array([[alleles.get(locus, MISSING) for locus in self.loci]], dtype=AlleleMatrix.dtype)
+        codes = self.encoding.translate(AlleleMatrix(["query"], self.loci, values))
+        aligned = np.zeros(self.blocks.shape[0] * self.block_loci, dtype=codes.dtype)
+        aligned[: len(self.loci)] = codes[0]
+
+        return aligned.reshape(self.blocks.shape[0], self.block_loci)
+
+    def block_rows(self, block: int, positions: np.ndarray) -> np.ndarray:
+        """one block of the samples at positions (the whole block is read when most samples are needed)"""
+        if len(positions) > len(self.samples) // 4:
+            return np.asarray(self.blocks[block])[positions]
+        return self.blocks[block][positions]
+
+    def rows(self, positions: np.ndarray) -> np.ndarray:
+        """all the blocks of the samples at positions (positions x n_blocks x block_loci)"""
+        return np.stack([self.block_rows(block, positions) for block in range(self.blocks.shape[0])], axis=1)
+
+
+def block_distances(rows: np.ndarray, query: np.ndarray) -> np.ndarray:
+    return count_differences(rows, query[None, :])[:, 0]
+
+
+def nearest_neighbours(
+    indexes: List[NeighbourIndex],
+    loci: List[str],
+    profile: np.ndarray,
+    k: int = 10,
+    max_distance: Optional[int] = None,
+    exclude: Optional[str] = None,
+) -> List[Tuple[str, int, int]]:
+    """
+    k samples of the indexes closest to an allele profile (alleles of loci), as (sample, distance, loci
+    called in both), closest first (ties in the order of the samples). With max_distance, only the
+    samples within that distance are returned. The sample named exclude (the query itself) is skipped.
+
+    The distance of a sample can only grow as blocks of loci are added, so after the first block the
+    exact distances of the k best samples so far give an upper bound of the k-th smallest distance, and
+    the samples whose partial distance goes above it are dropped before the next block is read.
+    """
+
+    queries = [index.align(loci, profile) for index in indexes]
+    positions = []
+    partial = []
+    for index, query in zip(indexes, queries):
+        candidates = np.array(
+            [i for i, sample in enumerate(index.samples) if sample != exclude], dtype=np.int64
+        )
+        positions.append(candidates)
+        partial.append(block_distances(index.block_rows(0, candidates), query[0]))
+
+    # bound from the exact distances of the k best samples of the first block
+    bound = np.inf if max_distance is None else max_distance
+    owners = np.concatenate([np.full(len(p), i) for i, p in enumerate(positions)] + [np.zeros(0, dtype=int)])
+    first = np.concatenate(partial + [np.zeros(0, dtype=int)])
+    if len(first) >= k:
+        exact = []
+        for seed in np.argpartition(first, k - 1)[:k].tolist():
+            i = int(owners[seed])
+            position = positions[i][seed - sum(len(p) for p in positions[:i])]
+            rows = indexes[i].rows(np.array([position]))
+            exact.append(int(block_distances(rows.reshape(1, -1), queries[i].reshape(-1))[0]))
+        bound = min(bound, max(exact))
+
+    n_blocks = indexes[0].blocks.shape[0] if indexes else 0
+    for block in range(n_blocks):
+        for i, (index, query) in enumerate(zip(indexes, queries)):
+            if block > 0 and len(positions[i]) > 0:
+                partial[i] = partial[i] + block_distances(index.block_rows(block, positions[i]), query[block])
+            keep = partial[i] <= bound
+            positions[i] = positions[i][keep]
+            partial[i] = partial[i][keep]
+
+    found = sorted(
+        (int(distance), i, int(position))
+        for i in range(len(indexes))
+        for distance, position in zip(partial[i].tolist(), positions[i].tolist())
+    )[:k]
+    neighbours = []
+    for distance, i, position in found:
+        rows = indexes[i].rows(np.array([position]))[0]
+        shared = int(((rows != MISSING) & (queries[i] != MISSING)).sum())
+        neighbours.append((indexes[i].samples[position], distance, shared))
+
+    return neighbours
+
+
+def query_profiles(
+    indexes: List[NeighbourIndex],
+    queries: Dict[str, Tuple[List[str], np.ndarray]],
+    k: int = 10,
+    max_distance: Optional[int] = None,
+    exclude_self: bool = False,
+) -> List[dict]:
+    """nearest neighbours of several profiles (name -> (loci, alleles)) as rows of a report"""
+
+    rows = []
+    for name, (loci, profile) in queries.items():
+        neighbours = nearest_neighbours(
+            indexes, loci, profile, k, max_distance, name if exclude_self else None
+        )
+        for rank, (sample, distance, shared) in enumerate(neighbours, 1):
+            rows.append(
+                {"query": name, "rank": rank, "sample": sample, "distance": distance, "shared_loci": shared}
+            )
+
+    return rows
@@ -1,16 +1,29 @@
+import concurrent.futures
 import json
+import math
 import os
 
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 
 import os
+import openpyxl
 import pandas as pd
 
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, Side
 
-def recursive_parse_json(json_dict, added_dict={}) -> dict:
+
+# version of the records extracted from the results files, to be increased whenever a change of the
+# parser changes the reports (the result caches of the runs are dropped when it changes)
+PARSER_VERSION = 1
+
+
+def recursive_parse_json(json_dict, added_dict: Optional[dict] = None) -> dict:
     """
     given a dictionary, return a dictionary of the last key and value pairs in the dictionary
     """
+    if added_dict is None:
+        added_dict = {}
     if isinstance(json_dict, dict):
         for key, value in json_dict.items():
             if isinstance(value, dict):
@@ -21,14 +34,41 @@ def recursive_parse_json(json_dict, added_dict={}) -> dict:
     return added_dict
 
 
+def write_excel(filename: str, sheets: Dict[str, pd.DataFrame]):
+    """
+    write the dataframes (sheet name -> dataframe) to an Excel file through a write-only openpyxl
+    workbook, which streams the rows to disk instead of keeping every cell in memory. The header
+    has the same style as the one of pandas.DataFrame.to_excel and missing values are left empty.
+    """
+    workbook = openpyxl.Workbook(write_only=True)
+    thin = Side(style="thin")
+    for sheet_name, dataframe in sheets.items():
+        worksheet = workbook.create_sheet(sheet_name)
+        if len(dataframe.columns) == 0:
+            continue
+        header = []
+        for column in dataframe.columns:
+            cell = WriteOnlyCell(worksheet, value=str(column))
+            cell.font = Font(bold=True)
+            cell.border = Border(left=thin, right=thin, top=thin, bottom=thin)
+            cell.alignment = Alignment(horizontal="center", vertical="top")
+            header.append(cell)
+        worksheet.append(header)
+        values = dataframe.astype(object).where(dataframe.notna(), None)
+        for row in values.itertuples(index=False, name=None):
+            worksheet.append(row)
+    workbook.save(filename)
+
+
 def find_efsa_output(sample_dir: str) -> str:
     """
-    Find the efsa output directory in the sample directory
+    Find the efsa output directory in the sample directory (only the sample directory is listed, so
+    the nextflow work folders are never walked)
     """
-    for root, dirs, files in os.walk(sample_dir):
-        for dir in dirs:
-            if not dir.startswith("work"):
-                return os.path.join(root, dir)
+    with os.scandir(sample_dir) as entries:
+        for entry in sorted(entries, key=lambda entry: entry.name):
+            if entry.is_dir() and not entry.name.startswith("work"):
+                return entry.path
     return None
 
 
@@ -149,7 +189,7 @@ class EfsaParser:
 
         for subsection, value in json_dict.items():
 
-            if not type(value) == dict:
+            if not isinstance(value, dict):
                 self.summary[subsection] = value
             elif subsection in self.section_process_dict:
                 self.summary.update(self.section_process_dict[subsection](value))
@@ -197,12 +237,10 @@ class EfsaParser:
 
         return pathotype_df
 
-    def amr_dict_to_df(self):
-
-        if "AMRProfile" not in self.gene_profiles:
-            return pd.DataFrame()
+    def amr_rows(self) -> List[dict]:
+        """one row per gene or variant of the AMR profile, with its first gene and its phenotypes joined"""
 
-        amr_df = []
+        amr_rows = []
 
         for genevar in self.gene_profiles["AMRProfile"]:
             for item, values in genevar.items():
@@ -212,9 +250,16 @@ class EfsaParser:
                 if values["phenotypes"] == "":
                     values["phenotypes"] = "-"
 
-                amr_df.append(values)
+                amr_rows.append(values)
 
-        amr_df = pd.DataFrame(amr_df)
+        return amr_rows
+
+    def amr_dict_to_df(self):
+
+        if "AMRProfile" not in self.gene_profiles:
+            return pd.DataFrame()
+
+        amr_df = pd.DataFrame(self.amr_rows())
         amr_df["Analysis_ID"] = self.analysis_id
 
         # column id as first column
@@ -241,6 +286,52 @@ class EfsaParser:
 
         return mlst_df
 
+    def to_records(self) -> Dict[str, List[dict]]:
+        """
+        rows of the summary, pathotypes, amr and mlst tables of this sample as plain records, with the columns
+        of the dataframes of summary_to_df, pathotype_dict_to_df, amr_dict_to_df and process_mlst_profile
+        (built directly, since a dataframe per table and sample costs far more than parsing the results)
+        """
+        self.process_summary()
+        profiles = self.gene_profiles
+
+        return {
+            "summary": [dict(self.summary)],
+            "pathotypes": table_records(profiles.get("PredictedPathotype", []), self.analysis_id, id_first=False),
+            "amr": table_records(self.amr_rows() if "AMRProfile" in profiles else [], self.analysis_id),
+            "mlst": table_records(profiles["MLSTProfile"][:1] if "MLSTProfile" in profiles else [], self.analysis_id),
+        }
+
+
+def table_records(rows: List[dict], analysis_id: str, id_first: bool = True) -> List[dict]:
+    """
+    records of the rows of a table of one sample with the columns of all the rows (in order of appearance, missing
+    values as NaN) and the Analysis_ID column first or last, as pd.DataFrame(rows) with that column would give
+    """
+
+    columns = list(dict.fromkeys(column for row in rows for column in row))
+    records = []
+    for row in rows:
+        record = {"Analysis_ID": analysis_id} if id_first else {}
+        record.update((column, row.get(column, math.nan)) for column in columns)
+        if not id_first:
+            record["Analysis_ID"] = analysis_id
+        records.append(record)
+
+    return records
+
+
+def parse_sample_records(sample: str, directory: str) -> Tuple[bool, Dict[str, List[dict]]]:
+    """
+    parse the results of one sample into plain records (see EfsaParser.to_records), together with
+    whether any results were found. Defined at module level so that it can run in a worker process.
+    """
+    parser = EfsaParser(directory, sample)
+    json_results = parser.parser.get_parsed_results()
+    parser.parse_json_results(json_results)
+
+    return bool(json_results), parser.to_records()
+
 
 class EfsaResults:
 
@@ -255,58 +346,83 @@ class EfsaResults:
         outputs_directory: str,
         output_file: str,
         log: bool = False,
+        workers: int = 1,
     ) -> None:
         self.dir_to_sample = dir_to_sample
         self.outputs_directory = outputs_directory
         self.output_file = os.path.join(outputs_directory, output_file)
-        self.parsed_results: List[EfsaParser] = []
+        # sample -> output of parse_sample_records
+        self.parsed_results: Dict[str, tuple] = {}
         self.log = log
+        self.workers = workers
 
     def merge_dataframes(self, dataframes: list) -> pd.DataFrame:
+        """
+        stack the rows of the dataframes column by column (union of their columns in order of
+        appearance), keeping the dtypes of the columns. Dataframes without rows add no columns.
+        """
+        dataframes = [df for df in dataframes if len(df.index) > 0]
+        if not dataframes:
+            return pd.DataFrame()
 
-        dataframes_to_dicts = [df.to_dict(orient="records") for df in dataframes]
-        merged_list = [item for sublist in dataframes_to_dicts for item in sublist]
-        merged_df = pd.DataFrame(merged_list)
-
-        return merged_df
+        return pd.concat(dataframes, ignore_index=True, sort=False)
+
+    def parse_all_results(self, cached: Optional[Dict[str, tuple]] = None):
+        """
+        parse the results of all the samples, in a pool of worker processes when workers > 1
+        (the records are collected in the order of the samples, so the tables are the same).
+        Samples in cached (sample -> output of parse_sample_records) are not parsed again.
+        """
+        cached = cached if cached is not None else {}
+        samples = [sample for sample in self.dir_to_sample.keys() if sample not in cached]
+        directories = [self.dir_to_sample[sample] for sample in samples]
+        if self.workers > 1 and len(samples) > 1:
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=min(self.workers, len(samples))
+            ) as executor:
+                parsed = dict(
+                    zip(
+                        samples,
+                        executor.map(
+                            parse_sample_records,
+                            samples,
+                            directories,
+                            chunksize=max(1, len(samples) // (4 * self.workers)),
+                        ),
+                    )
+                )
+        else:
+            parsed = dict(zip(samples, map(parse_sample_records, samples, directories)))
 
-    def parse_all_results(self):
-        for sample, directory in self.dir_to_sample.items():
+        for sample in self.dir_to_sample.keys():
+            found, records = cached[sample] if sample in cached else parsed[sample]
             if self.log:
                 print(f"Processing {sample}")
-            parser = EfsaParser(directory, sample)
-            json_results = parser.parser.get_parsed_results()
-            if not json_results and self.log:
+            if not found and self.log:
                 print(f"No results found for {sample}")
-            parser.parse_json_results(json_results)
-            parser.process_summary()
-            self.parsed_results.append(parser)
+            self.parsed_results[sample] = (found, records)
+
+    def merge_records(self, table: str) -> pd.DataFrame:
+        """table of all the samples, built once from their records"""
+        return pd.DataFrame(
+            [
+                record
+                for found, records in self.parsed_results.values()
+                for record in records[table]
+            ]
+        )
 
     def merge_summaries(self):
-        summary_dfs = [parser.summary_to_df() for parser in self.parsed_results]
-        merged_df = self.merge_dataframes(summary_dfs)
-
-        return merged_df
+        return self.merge_records("summary")
 
     def merge_pathotypes(self):
-        pathotype_dfs = [
-            parser.pathotype_dict_to_df() for parser in self.parsed_results
-        ]
-        merged_df = self.merge_dataframes(pathotype_dfs)
-
-        return merged_df
+        return self.merge_records("pathotypes")
 
     def merge_amr_profiles(self):
-        amr_dfs = [parser.amr_dict_to_df() for parser in self.parsed_results]
-        merged_df = self.merge_dataframes(amr_dfs)
-
-        return merged_df
+        return self.merge_records("amr")
 
     def merge_mlst_profiles(self):
-        mlst_dfs = [parser.process_mlst_profile() for parser in self.parsed_results]
-        merged_df = self.merge_dataframes(mlst_dfs)
-
-        return merged_df
+        return self.merge_records("mlst")
 
     def check_output_file(self):
 
@@ -354,9 +470,9 @@ class EfsaResults:
 
         return summary_df, pathotype_df, amr_df, mlst_df
 
-    def compound_output(self):
+    def compound_output(self, merge_existing: bool = True):
 
-        if self.check_output_file():
+        if merge_existing and self.check_output_file():
             summary_df, pathotype_df, amr_df, mlst_df = (
                 self.merge_output_with_existing()
             )
@@ -375,9 +491,10 @@ class EfsaResults:
         dataframe = dataframe.drop_duplicates().reset_index(drop=True)
         return dataframe
 
-    def process_output(self):
+    def process_output(self, merge_existing: bool = True):
+        """final tables of the samples (added to the ones of the existing output file if merge_existing)"""
 
-        summary_df, pathotype_df, amr_df, mlst_df = self.compound_output()
+        summary_df, pathotype_df, amr_df, mlst_df = self.compound_output(merge_existing)
 
         summary_df = self.process_df(summary_df)
         pathotype_df = self.process_df(pathotype_df)
@@ -401,13 +518,15 @@ class EfsaResults:
 
         os.makedirs(self.outputs_directory, exist_ok=True)
 
-        with pd.ExcelWriter(self.output_file) as writer:
-            summary_df.to_excel(writer, sheet_name=self.SUMMARY_SHEET_NAME, index=False)
-            pathotype_df.to_excel(
-                writer, sheet_name=self.PATHOTYPES_SHEET_NAME, index=False
-            )
-            amr_df.to_excel(writer, sheet_name=self.AMR_SHEET_NAME, index=False)
-            mlst_df.to_excel(writer, sheet_name=self.MLST_SHEET_NAME, index=False)
+        write_excel(
+            self.output_file,
+            {
+                self.SUMMARY_SHEET_NAME: summary_df,
+                self.PATHOTYPES_SHEET_NAME: pathotype_df,
+                self.AMR_SHEET_NAME: amr_df,
+                self.MLST_SHEET_NAME: mlst_df,
+            },
+        )
 
         summary_df.to_csv(
             os.path.join(self.outputs_directory, "summary.tsv"), sep="\t", index=False
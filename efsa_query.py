@@ -0,0 +1,242 @@
+import io
+import json
+import os
+
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+
+class TableIndex:
+    """
+    persistent indexes over the cumulative tables of a run (summary.tsv, mlst.tsv, amr.tsv and pathotypes.tsv)
+
+    For each table the byte offsets of the rows of each sample (Analysis_ID) are kept, so the rows of the
+    selected samples are read by seeking to them instead of loading the whole table. The samples are also
+    indexed by the values of the columns they are usually filtered by (ST, Serotype, QC_VOTE and
+    MashSpeciesDetected of the summary), with numeric values written as floats in the tables (e.g. an ST of
+    "21.0") indexed as integers ("21") and species matched regardless of case. All the tables are read in a single pass. The samples carrying given genes are found
+    in the gene presence matrices of the run store instead (see GenePresence).
+
+    Samples and values are numbered and the indexes are kept as int64 arrays: row offsets of each table
+    (the offsets of sample i in offsets[starts[i]:starts[i + 1]]) and the value of each sample for each
+    filter (-1 if it has none). They are saved to <run>/query_index.bin (the arrays one after the other) and
+    <run>/query_index.json (names of the samples and values, position of each array and size and
+    modification time of each table), so they are only built again when a table changed (e.g. the run was
+    materialized again).
+    """
+
+    index_file = "query_index.json"
+    data_file = "query_index.bin"
+    dtype = np.dtype("<i8")
+    format_version = 3
+    tables = ["summary", "mlst", "amr", "pathotypes"]
+    # filter -> column of the summary
+    filters = {"st": "ST", "serotype": "Serotype", "qc": "QC_VOTE", "species": "MashSpeciesDetected"}
+    # filters matched regardless of case
+    case_insensitive = ["species"]
+
+    def __init__(
+        self,
+        run_directory: str,
+        files: Dict[str, list],
+        samples: List[str],
+        values: Dict[str, List[str]],
+        arrays: Dict[str, np.ndarray],
+    ) -> None:
+
+        self.run_directory = run_directory
+        # table -> [size, mtime_ns] of its file when it was indexed
+        self.files = files
+        # samples in the order of the tables
+        self.samples = samples
+        # filter -> distinct values
+        self.values = values
+        # <table>.starts and <table>.offsets and <filter>.values
+        self.arrays = arrays
+
+    @classmethod
+    def table_file(cls, run_directory: str, table: str) -> str:
+        return os.path.join(run_directory, table + ".tsv")
+
+    @classmethod
+    def file_stats(cls, run_directory: str) -> Dict[str, list]:
+        stats = {}
+        for table in cls.tables:
+            filename = cls.table_file(run_directory, table)
+            if os.path.exists(filename):
+                stat = os.stat(filename)
+                stats[table] = [stat.st_size, stat.st_mtime_ns]
+
+        return stats
+
+    @staticmethod
+    def normalise(value: str) -> str:
+        """value as indexed: numbers without a fractional part are written as integers (e.g. "21.0" is "21")"""
+
+        try:
+            number = float(value)
+        except ValueError:
+            return value
+
+        return str(int(number)) if number.is_integer() else value
+
+    @staticmethod
+    def compress(owners: List[int], entries: List[int], n_owners: int) -> List[np.ndarray]:
+        """starts and entries (grouped by owner, in their order) of a list of (owner, entry) pairs"""
+
+        owners = np.array(owners, dtype=np.int64)
+        order = np.argsort(owners, kind="stable")
+        starts = np.concatenate([[0], np.cumsum(np.bincount(owners, minlength=n_owners))])
+
+        return [starts.astype(np.int64), np.array(entries, dtype=np.int64)[order]]
+
+    @classmethod
+    def build(cls, run_directory: str) -> "TableIndex":
+        """index the tables of the run (one pass over each file)"""
+
+        number = {}
+        rows = {}
+        values = {name: {} for name in cls.filters}
+        sample_values = {name: {} for name in cls.filters}
+        for table in cls.tables:
+            rows[table] = ([], [])
+            filename = cls.table_file(run_directory, table)
+            if not os.path.exists(filename):
+                continue
+            with open(filename, "rb") as infile:
+                header = infile.readline().decode().rstrip("\n").split("\t")
+                if "Analysis_ID" not in header:
+                    continue
+                id_position = header.index("Analysis_ID")
+                positions = {}
+                if table == "summary":
+                    positions = {
+                        name: header.index(column) for name, column in cls.filters.items() if column in header
+                    }
+                offset = infile.tell()
+                for line in infile:
+                    fields = line.decode().rstrip("\n").split("\t")
+                    if len(fields) > id_position:
+                        sample = number.setdefault(fields[id_position], len(number))
+                        rows[table][0].append(sample)
+                        rows[table][1].append(offset)
+                        for name, position in positions.items():
+                            if position < len(fields):
+                                value = cls.normalise(fields[position])
+                                sample_values[name][sample] = values[name].setdefault(value, len(values[name]))
+                    offset += len(line)
+
+        arrays = {}
+        for table in cls.tables:
+            arrays[table + ".starts"], arrays[table + ".offsets"] = cls.compress(*rows[table], len(number))
+        for name in cls.filters:
+            codes = np.full(len(number), -1, dtype=np.int64)
+            codes[list(sample_values[name].keys())] = list(sample_values[name].values())
+            arrays[name + ".values"] = codes
+
+        return cls(
+            run_directory,
+            cls.file_stats(run_directory),
+            list(number),
+            {name: list(values[name]) for name in cls.filters},
+            arrays,
+        )
+
+    @classmethod
+    def open(cls, run_directory: str) -> "TableIndex":
+        """load the saved indexes of the run, or build (and save) them if they are missing or out of date"""
+
+        filename = os.path.join(run_directory, cls.index_file)
+        if os.path.exists(filename) and os.path.exists(os.path.join(run_directory, cls.data_file)):
+            with open(filename) as infile:
+                index = json.load(infile)
+            if index.get("format_version") == cls.format_version and index["files"] == cls.file_stats(run_directory):
+                data = np.fromfile(os.path.join(run_directory, cls.data_file), dtype=cls.dtype)
+                arrays = {name: data[start : start + length] for name, (start, length) in index["arrays"].items()}
+                return cls(run_directory, index["files"], index["samples"], index["values"], arrays)
+        index = cls.build(run_directory)
+        index.save()
+
+        return index
+
+    def save(self):
+        """write the arrays and the index to the run directory"""
+
+        positions = {}
+        start = 0
+        for name, array in self.arrays.items():
+            positions[name] = [start, len(array)]
+            start += len(array)
+        data = np.concatenate([np.zeros(0, dtype=self.dtype)] + list(self.arrays.values())).astype(self.dtype)
+        data.tofile(os.path.join(self.run_directory, self.data_file))
+        filename = os.path.join(self.run_directory, self.index_file)
+        with open(filename + ".tmp", "w") as outfile:
+            json.dump(
+                {
+                    "format_version": self.format_version,
+                    "files": self.files,
+                    "samples": self.samples,
+                    "values": self.values,
+                    "arrays": positions,
+                },
+                outfile,
+            )
+        os.replace(filename + ".tmp", filename)
+
+    def entries(self, table: str, samples: List[int]) -> np.ndarray:
+        """row offsets of the samples in a table"""
+
+        starts = self.arrays[table + ".starts"]
+        offsets = self.arrays[table + ".offsets"]
+
+        return np.concatenate(
+            [np.zeros(0, dtype=self.dtype)] + [offsets[starts[sample] : starts[sample + 1]] for sample in samples]
+        )
+
+    def select(self, samples: Optional[List[str]] = None, **filters: List[str]) -> List[str]:
+        """
+        samples (in the order of the tables) that are among the given samples and have any of the values given
+        for each filter (e.g. st=["11", "21"]; a QC_VOTE of "FAIL: <reason>" matches FAIL, and species are matched regardless of case)
+        """
+
+        selected = np.ones(len(self.samples), dtype=bool)
+        if samples:
+            wanted = set(str(sample) for sample in samples)
+            selected &= np.array([sample in wanted for sample in self.samples], dtype=bool)
+        for name, wanted in filters.items():
+            if wanted:
+                wanted = [self.normalise(str(item)) for item in wanted]
+                values = self.values[name]
+                if name in self.case_insensitive:
+                    wanted = [item.lower() for item in wanted]
+                    values = [value.lower() for value in values]
+                codes = [
+                    code
+                    for code, value in enumerate(values)
+                    if any(value == item or value.startswith(item + ":") for item in wanted)
+                ]
+                selected &= np.isin(self.arrays[name + ".values"], codes)
+
+        return [self.samples[i] for i in np.flatnonzero(selected).tolist()]
+
+    def read_rows(self, table: str, samples: List[str]) -> pd.DataFrame:
+        """rows of the samples in a table, read at their offsets (in the order of the table)"""
+
+        filename = self.table_file(self.run_directory, table)
+        if not os.path.exists(filename) or table not in self.files:
+            return pd.DataFrame()
+        number = {sample: i for i, sample in enumerate(self.samples)}
+        offsets = np.sort(self.entries(table, [number[sample] for sample in samples if sample in number]))
+        with open(filename, "rb") as infile:
+            lines = [infile.readline()]
+            for offset in offsets.tolist():
+                infile.seek(offset)
+                lines.append(infile.readline())
+
+        return pd.read_table(io.BytesIO(b"".join(lines)), dtype=str, keep_default_na=False)
+
+    def query(self, samples: List[str]) -> Dict[str, pd.DataFrame]:
+        """rows of the samples in all the tables (table name -> dataframe)"""
+        return {table: self.read_rows(table, samples) for table in self.tables}
@@ -0,0 +1,624 @@
+import datetime
+import json
+import os
+import shutil
+
+from typing import List, Optional, Tuple, Union
+
+import pandas as pd
+
+from efsa_alleles import AlleleMatrix, EncodedAlleleMatrix
+from efsa_clusters import ClusterState
+from efsa_distances import DistanceMatrix
+from efsa_genes import GENE_TABLES, GenePresence, as_categoricals
+from efsa_neighbours import NeighbourIndex
+from efsa_parser import write_excel
+
+
+class RunStore:
+    """
+    cumulative results of a chain of runs kept as one partition per run plus a manifest
+
+    Each run only writes its own samples to <run>/partition/ (summary, mlst, amr, pathotypes
+    with the presence matrices of their AMR and pathotype genes, and the dictionary-encoded allele matrix) and a store_manifest.json listing the partitions of all the
+    runs it builds on. The cumulative tables are produced from the partitions when needed.
+    Runs created before the manifest existed are read as a single (legacy) partition holding
+    their cumulative tables.
+    """
+
+    manifest_file = "store_manifest.json"
+    partition_directory = "partition"
+    format_version = 1
+    tables = ["summary", "mlst", "amr", "pathotypes"]
+    # keys of a partition entry holding paths relative to the run directory
+    path_keys = ["path", "distances", "clusters", "neighbours", "genes"]
+    sheet_names = {
+        "summary": "Summary",
+        "mlst": "MLST",
+        "amr": "AMR",
+        "pathotypes": "Pathotypes",
+    }
+    gene_sheet_names = {
+        "amr": ("AMR presence", "AMR genes"),
+        "pathotypes": ("Pathotype presence", "Pathotype genes"),
+    }
+    # cumulative view -> table of the partitions whose rows it holds, in order (the views that can be appended to)
+    view_sources = {
+        "summary": "summary",
+        "mlst": "mlst",
+        "amr": "amr",
+        "pathotypes": "pathotypes",
+        "amr_presence": "amr",
+        "pathotypes_presence": "pathotypes",
+    }
+
+    def __init__(
+        self,
+        run_directory: str,
+        partitions: Optional[List[dict]] = None,
+        report_file: str = "",
+        views: Optional[dict] = None,
+    ) -> None:
+
+        self.run_directory = os.path.abspath(run_directory)
+        self.partitions = partitions if partitions is not None else []
+        self.report_file = report_file
+        # view -> sources ([size, mtime_ns] of the table of each partition), file ([size, mtime_ns]), rows, columns
+        self.views = views if views is not None else {}
+
+    @classmethod
+    def open(cls, run_directory: str) -> "RunStore":
+        """open the store of an existing run (a run without manifest is a legacy partition)"""
+
+        manifest = os.path.join(run_directory, cls.manifest_file)
+        if not os.path.exists(manifest):
+            return cls(
+                run_directory,
+                [
+                    {
+                        "run": os.path.basename(os.path.abspath(run_directory)),
+                        "path": ".",
+                        "legacy": True,
+                    }
+                ],
+            )
+
+        with open(manifest) as infile:
+            manifest = json.load(infile)
+
+        return cls(run_directory, manifest["partitions"], manifest.get("report_file", ""), manifest.get("views", {}))
+
+    @classmethod
+    def create(
+        cls, run_directory: str, report_file: str, previous_run: str = ""
+    ) -> "RunStore":
+        """new store holding the partitions of the previous run (if any) followed by the partition of this run"""
+
+        store = cls(run_directory, [], report_file)
+        if previous_run != "":
+            previous = cls.open(previous_run)
+            for partition, path in zip(previous.partitions, previous.partition_paths()):
+                partition = dict(partition)
+                for key in cls.path_keys:
+                    if key in partition:
+                        partition[key] = os.path.relpath(
+                            os.path.join(previous.run_directory, partition[key]),
+                            store.run_directory,
+                        )
+                store.partitions.append(partition)
+        store.partitions.append(
+            {
+                "run": os.path.basename(store.run_directory),
+                "path": cls.partition_directory,
+                "legacy": False,
+                "created": str(datetime.datetime.now()),
+            }
+        )
+
+        return store
+
+    def save(self):
+        with open(os.path.join(self.run_directory, self.manifest_file), "w") as outfile:
+            json.dump(
+                {
+                    "format_version": self.format_version,
+                    "report_file": self.report_file,
+                    "partitions": self.partitions,
+                    "views": self.views,
+                },
+                outfile,
+                indent=4,
+            )
+
+    def partition_paths(self) -> List[str]:
+        return [
+            os.path.normpath(os.path.join(self.run_directory, partition["path"]))
+            for partition in self.partitions
+        ]
+
+    @property
+    def own_partition(self) -> str:
+        """directory of the partition written by this run"""
+        return self.partition_paths()[-1]
+
+    @staticmethod
+    def read_partition_table(path: str, table: str) -> pd.DataFrame:
+        try:
+            return pd.read_table(os.path.join(path, table + ".tsv"))
+        except (pd.errors.EmptyDataError, FileNotFoundError):
+            return pd.DataFrame()
+
+    def read_table(self, table: str, own: Optional[pd.DataFrame] = None) -> pd.DataFrame:
+        """
+        cumulative table of all the partitions (the gene tables with their repeated text columns as categoricals).
+        The table of this run's partition is taken from own when given (e.g. just written), instead of read back.
+        """
+
+        paths = self.partition_paths()
+        dataframes = [self.read_partition_table(path, table) for path in paths[: len(paths) - (own is not None)]]
+        if own is not None:
+            dataframes.append(own)
+        dataframes = [df for df in dataframes if not df.empty]
+        if not dataframes:
+            return pd.DataFrame()
+        if table in GENE_TABLES:
+            return as_categoricals(pd.concat(dataframes, ignore_index=True))
+
+        return pd.concat(dataframes, ignore_index=True)
+
+    def write_partition_tables(self, tables: dict):
+        """write the tables of this run (table name -> dataframe) to its partition"""
+
+        os.makedirs(self.own_partition, exist_ok=True)
+        for table in self.tables:
+            tables[table].to_csv(
+                os.path.join(self.own_partition, table + ".tsv"),
+                index=False,
+                header=True,
+                sep="\t",
+            )
+        samples = tables["summary"]["Analysis_ID"].tolist() if "Analysis_ID" in tables["summary"].columns else []
+        for table in GENE_TABLES:
+            GenePresence.from_dataframe(table, tables[table], samples).save(self.own_partition)
+
+    def update_gene_presence(self, persist: bool = True) -> dict:
+        """
+        cumulative presence matrices of the AMR and pathotype genes (table name -> GenePresence), appended
+        partition by partition. The matrices missing in previous runs (e.g. legacy runs) are built from their
+        tables and, if persist, kept in the partition of this run (otherwise nothing is written to the run).
+        """
+
+        presence = {table: GenePresence.empty(table) for table in GENE_TABLES}
+        changed = False
+        for i, (partition, path) in enumerate(zip(self.partitions, self.partition_paths())):
+            directory = path
+            if "genes" in partition:
+                directory = os.path.normpath(os.path.join(self.run_directory, partition["genes"]))
+            if all(GenePresence.exists(directory, table) for table in GENE_TABLES):
+                for table in GENE_TABLES:
+                    presence[table] = presence[table].append(GenePresence.load(directory, table))
+                continue
+            summary = self.read_partition_table(path, "summary")
+            samples = summary["Analysis_ID"].tolist() if "Analysis_ID" in summary.columns else []
+            built = {
+                table: GenePresence.from_dataframe(table, self.read_partition_table(path, table), samples)
+                for table in GENE_TABLES
+            }
+            if persist:
+                if i == len(self.partitions) - 1:
+                    directory = self.own_partition
+                else:
+                    directory = os.path.join(self.own_partition, "genes", str(i) + "_" + partition["run"])
+                os.makedirs(directory, exist_ok=True)
+                for table in GENE_TABLES:
+                    built[table].save(directory)
+                partition["genes"] = os.path.relpath(directory, self.run_directory)
+                changed = True
+            for table in GENE_TABLES:
+                presence[table] = presence[table].append(built[table])
+        if changed:
+            self.save()
+
+        return presence
+
+    def write_partition_alleles(self, alleles: AlleleMatrix):
+        """write the allele matrix of this run to its partition, dictionary-encoded"""
+
+        os.makedirs(self.own_partition, exist_ok=True)
+        EncodedAlleleMatrix.encode(alleles).save(self.own_partition)
+
+    @staticmethod
+    def open_partition_alleles(path: str) -> Optional[Union[AlleleMatrix, EncodedAlleleMatrix]]:
+        """allele matrix of a partition as stored (memory-mapped and not decoded), None if it has none"""
+
+        if EncodedAlleleMatrix.exists(path):
+            return EncodedAlleleMatrix.load(path)
+        if AlleleMatrix.exists(path):
+            return AlleleMatrix.load(path)
+        if os.path.exists(os.path.join(path, "alleles.tsv")):
+            return AlleleMatrix.from_tsv(os.path.join(path, "alleles.tsv"))
+        return None
+
+    @staticmethod
+    def read_partition_allele_header(path: str) -> List[str]:
+        """id column followed by the loci of a partition, without loading its alleles"""
+
+        for matrix in [EncodedAlleleMatrix, AlleleMatrix]:
+            if matrix.exists(path):
+                with open(os.path.join(path, matrix.index_file)) as infile:
+                    index = json.load(infile)
+                return [index["id_column"]] + index["loci"]
+        if os.path.exists(os.path.join(path, "alleles.tsv")):
+            with open(os.path.join(path, "alleles.tsv")) as infile:
+                return infile.readline().rstrip("\n").split("\t")
+        return []
+
+    @staticmethod
+    def read_partition_allele_samples(path: str) -> List[str]:
+        """samples of a partition, without loading its alleles"""
+
+        for matrix in [EncodedAlleleMatrix, AlleleMatrix]:
+            if matrix.exists(path):
+                with open(os.path.join(path, matrix.index_file)) as infile:
+                    return json.load(infile)["samples"]
+        if os.path.exists(os.path.join(path, "alleles.tsv")):
+            with open(os.path.join(path, "alleles.tsv")) as infile:
+                infile.readline()
+                return [line.split("\t", 1)[0] for line in infile if "\t" in line]
+        return []
+
+    def allele_header(self) -> List[str]:
+        for path in self.partition_paths():
+            header = self.read_partition_allele_header(path)
+            if header:
+                return header
+        return []
+
+    def allele_samples(self) -> List[str]:
+        samples = []
+        for path in self.partition_paths():
+            samples.extend(self.read_partition_allele_samples(path))
+        return samples
+
+    def read_alleles(self, samples: Optional[List[str]] = None) -> AlleleMatrix:
+        """
+        cumulative allele matrix of all the partitions, or only of the given samples (in that order, the
+        ones not found are left out), in which case only their rows are read
+        """
+
+        matrices = [self.open_partition_alleles(path) for path in self.partition_paths()]
+        matrices = [matrix for matrix in matrices if matrix is not None and matrix.loci]
+        if not matrices:
+            return AlleleMatrix.empty([])
+        if samples is None:
+            return AlleleMatrix.concatenate(
+                [matrix.decode() if isinstance(matrix, EncodedAlleleMatrix) else matrix for matrix in matrices]
+            )
+
+        wanted = set(samples)
+        found = []
+        for matrix in matrices:
+            positions = [i for i, sample in enumerate(matrix.samples) if sample in wanted]
+            found.append(matrix.take(positions))
+        alleles = AlleleMatrix.concatenate(found)
+        rows = alleles.sample_index()
+
+        return alleles.take([rows[sample] for sample in samples if sample in rows])
+
+    def previous_run_directory(self) -> Optional[str]:
+        """directory of the run this one builds on (None if there is none)"""
+
+        if len(self.partitions) < 2:
+            return None
+        path = self.partition_paths()[-2]
+
+        return path if self.partitions[-2].get("legacy") else os.path.dirname(path)
+
+    def find_allele_view(self, directory: str, samples: List[List[str]]) -> Tuple[Optional[str], int]:
+        """
+        cumulative allele matrix that can be reused to write the one of directory: directory itself if it
+        already holds the samples of all the partitions, or else the matrix of the previous run if it holds
+        the samples of all the partitions but this one. Returned as (its directory, partitions it covers),
+        (None, 0) if there is none.
+        """
+
+        loci = set(self.allele_header()[1:])
+        candidates = [(directory, len(samples)), (self.previous_run_directory(), len(samples) - 1)]
+        for view, covered in candidates:
+            if view is None or not loci or not AlleleMatrix.exists(view):
+                continue
+            if not os.path.exists(os.path.join(view, "alleles.tsv")):
+                continue
+            with open(os.path.join(view, AlleleMatrix.index_file)) as infile:
+                index = json.load(infile)
+            if set(index["loci"]) == loci and index["samples"] == [s for part in samples[:covered] for s in part]:
+                return view, covered
+
+        return None, 0
+
+    @staticmethod
+    def write_tsv_chunks(alleles: Union[AlleleMatrix, EncodedAlleleMatrix], loci: List[str], tsv_file: str):
+        """blocks of rows of alleles (loci in the given order), each one added to tsv_file as it is read"""
+
+        for chunk in alleles.iter_chunks():
+            chunk = chunk.select_loci(loci)
+            chunk.to_tsv(tsv_file, append=True)
+            yield chunk
+
+    def write_alleles(self, directory: str):
+        """
+        write the cumulative allele matrix to directory (alleles.bin and alleles.tsv). When the matrix of the
+        previous run is there, it is copied and only the partition of this run is appended (nothing is written
+        if directory already holds all the samples); otherwise all the partitions are appended. Partitions
+        are appended block by block so that only one block of rows is in memory at a time.
+        """
+
+        paths = self.partition_paths()
+        view, covered = self.find_allele_view(directory, [self.read_partition_allele_samples(path) for path in paths])
+        if view == directory:
+            return
+        tsv_file = os.path.join(directory, "alleles.tsv")
+        # the index goes first (and comes back last), so an interrupted write is never taken for a complete one
+        for filename in [AlleleMatrix.index_file, AlleleMatrix.data_file, "alleles.tsv"]:
+            if os.path.exists(os.path.join(directory, filename)):
+                os.remove(os.path.join(directory, filename))
+        loci = None
+        if view is not None:
+            for filename in [AlleleMatrix.data_file, "alleles.tsv", AlleleMatrix.index_file]:
+                shutil.copyfile(os.path.join(view, filename), os.path.join(directory, filename))
+            with open(os.path.join(directory, AlleleMatrix.index_file)) as infile:
+                loci = json.load(infile)["loci"]
+        for path in paths[covered:]:
+            alleles = self.open_partition_alleles(path)
+            if alleles is None or not alleles.loci:
+                continue
+            if loci is None:
+                loci = alleles.loci
+                empty = AlleleMatrix.empty(loci, alleles.id_column)
+                empty.save(directory)
+                empty.to_tsv(tsv_file)
+            AlleleMatrix.append_chunks(directory, self.write_tsv_chunks(alleles, loci, tsv_file))
+        if loci is None:
+            AlleleMatrix.empty([]).save(directory)
+            AlleleMatrix.empty([]).to_tsv(tsv_file)
+
+    def update_distances(self, threads: int = 1) -> List[DistanceMatrix]:
+        """
+        make sure every partition has its block of distances (its samples against all the samples up to it)
+        and return the blocks in order. Blocks of previous runs are reused, so only the block of this run
+        is computed (k x N); blocks missing in previous runs (e.g. legacy runs) are computed once and kept
+        in the partition of this run.
+        """
+
+        blocks = []
+        previous = []
+        for i, (partition, path) in enumerate(zip(self.partitions, self.partition_paths())):
+            alleles = self.open_partition_alleles(path)
+            if alleles is None or not alleles.loci:
+                continue
+            columns = [sample for matrix in previous for sample in matrix.samples] + alleles.samples
+            block = None
+            if "distances" in partition and i < len(self.partitions) - 1:
+                block_dir = os.path.normpath(os.path.join(self.run_directory, partition["distances"]))
+                if DistanceMatrix.exists(block_dir):
+                    block = DistanceMatrix.load(block_dir)
+                    if block.samples != alleles.samples or block.columns != columns:
+                        block = None
+            if block is None:
+                if i == len(self.partitions) - 1:
+                    block_dir = self.own_partition
+                else:
+                    block_dir = os.path.join(self.own_partition, "distances", str(i) + "_" + partition["run"])
+                os.makedirs(block_dir, exist_ok=True)
+                block = DistanceMatrix.compute_block(alleles, previous, block_dir, threads)
+                partition["distances"] = os.path.relpath(block_dir, self.run_directory)
+            blocks.append(block)
+            previous.append(alleles)
+        self.save()
+
+        return blocks
+
+    def update_neighbour_indexes(self) -> List[NeighbourIndex]:
+        """
+        make sure every partition with alleles has its neighbour index and return them in order. Indexes of
+        previous runs are reused; the ones missing (e.g. legacy runs) are built once and kept in the partition
+        of this run.
+        """
+
+        indexes = []
+        changed = False
+        for i, (partition, path) in enumerate(zip(self.partitions, self.partition_paths())):
+            if not self.read_partition_allele_header(path):
+                continue
+            index = None
+            if "neighbours" in partition:
+                directory = os.path.normpath(os.path.join(self.run_directory, partition["neighbours"]))
+                if NeighbourIndex.exists(directory):
+                    index = NeighbourIndex.load(directory)
+                    if index.samples != self.read_partition_allele_samples(path):
+                        index = None
+            if index is None:
+                if i == len(self.partitions) - 1:
+                    directory = self.own_partition
+                else:
+                    directory = os.path.join(self.own_partition, "neighbours", str(i) + "_" + partition["run"])
+                os.makedirs(directory, exist_ok=True)
+                index = NeighbourIndex.build(self.open_partition_alleles(path), directory)
+                partition["neighbours"] = os.path.relpath(directory, self.run_directory)
+                changed = True
+            indexes.append(index)
+        if changed:
+            self.save()
+
+        return indexes
+
+    def update_clusters(self, blocks: List[DistanceMatrix], thresholds: List[int]) -> ClusterState:
+        """extend the cluster assignment of the previous run (if any) with the samples of this run"""
+
+        previous = ClusterState()
+        for partition in reversed(self.partitions[:-1]):
+            if "clusters" in partition:
+                directory = os.path.normpath(os.path.join(self.run_directory, partition["clusters"]))
+                if ClusterState.exists(directory):
+                    previous = ClusterState.load(directory)
+                break
+        state = previous.update(blocks, thresholds, self.partitions[-1]["run"])
+        state.save(self.own_partition)
+        self.partitions[-1]["clusters"] = os.path.relpath(self.own_partition, self.run_directory)
+        self.save()
+
+        return state
+
+    def read_clusters(self) -> Optional[ClusterState]:
+        """cluster assignment of this run (None if clustering was not requested)"""
+
+        if "clusters" not in self.partitions[-1]:
+            return None
+        directory = os.path.normpath(os.path.join(self.run_directory, self.partitions[-1]["clusters"]))
+        if not ClusterState.exists(directory):
+            return None
+
+        return ClusterState.load(directory)
+
+    @staticmethod
+    def file_stat(filename: str) -> Optional[list]:
+        if not os.path.exists(filename):
+            return None
+        stat = os.stat(filename)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def view_record(self, view: str, sources: List[Optional[list]], columns: List[str]) -> Optional[dict]:
+        """
+        record of a view of this run or of the previous run that holds the rows of the first partitions of
+        sources (all of them or all but this run's), has the given columns and was not changed since written
+        """
+
+        candidates = [(self.run_directory, self.views, len(sources))]
+        previous_run = self.previous_run_directory()
+        if previous_run is not None and not self.partitions[-2].get("legacy"):
+            candidates.append((previous_run, RunStore.open(previous_run).views, len(sources) - 1))
+        for directory, views, covered in candidates:
+            record = views.get(view)
+            if record is None or record["sources"] != sources[:covered] or record["columns"] != columns:
+                continue
+            if record["file"] == self.file_stat(os.path.join(directory, view + ".tsv")):
+                return dict(record, directory=directory)
+
+        return None
+
+    def write_view(self, view: str, df: pd.DataFrame, appendable: bool = True):
+        """
+        write a cumulative table to <run>/<view>.tsv. When the view of the previous run holds the rows of the
+        partitions before this one, which did not change since, and has the same columns, it is copied and
+        only the rows of this run's partition are appended to it (nothing is written if this run's view
+        already holds them all). Views whose earlier rows may change (e.g. a summary with clusters) are not
+        appendable and are always written in full.
+        """
+
+        filename = os.path.join(self.run_directory, view + ".tsv")
+        columns = [str(column) for column in df.columns]
+        sources = [
+            self.file_stat(os.path.join(path, self.view_sources.get(view, view) + ".tsv"))
+            for path in self.partition_paths()
+        ]
+        record = self.view_record(view, sources, columns) if appendable and view in self.view_sources else None
+        self.views.pop(view, None)
+        if record is not None and record["directory"] == self.run_directory and record["rows"] == len(df.index):
+            self.views[view] = {key: record[key] for key in ["sources", "file", "rows", "columns"]}
+            return
+        if record is not None and record["rows"] <= len(df.index):
+            if record["directory"] != self.run_directory:
+                shutil.copyfile(os.path.join(record["directory"], view + ".tsv"), filename)
+            df.iloc[record["rows"] :].to_csv(filename, mode="a", index=False, header=False, sep="\t")
+        else:
+            df.to_csv(filename, index=False, header=True, sep="\t")
+        if appendable and view in self.view_sources:
+            self.views[view] = {
+                "sources": sources,
+                "file": self.file_stat(filename),
+                "rows": len(df.index),
+                "columns": columns,
+            }
+
+    def materialize(self, square_distances: bool = False, own_tables: Optional[dict] = None):
+        """
+        write the cumulative views (TSV reports, Excel report, allele matrix and clusters) to the run directory.
+        The TSV reports of the previous run are extended with the rows of this run when possible (see write_view).
+        The tables of this run's partition are taken from own_tables (table name -> dataframe) when given, e.g.
+        by the report stage that has just written them, so they are not read back from the partition.
+        The square matrix of the distances between all the samples is only assembled from the distance blocks
+        of the partitions with square_distances, since it is rewritten in full ((N + k)^2 cells) every time.
+        """
+
+        own_tables = own_tables if own_tables is not None else {}
+        tables = {table: self.read_table(table, own_tables.get(table)) for table in self.tables}
+        clusters = self.read_clusters()
+        if clusters is not None and not tables["summary"].empty:
+            for column, assignment in clusters.to_dict().items():
+                tables["summary"][column] = tables["summary"]["Analysis_ID"].map(assignment).fillna("-")
+            merges = [dict(merge, merged=", ".join(merge["merged"])) for merge in clusters.merges]
+            pd.DataFrame(merges, columns=["run", "threshold", "merged", "into"]).to_csv(
+                os.path.join(self.run_directory, "cluster_merges.tsv"),
+                index=False,
+                header=True,
+                sep="\t",
+            )
+        sheets = {self.sheet_names[table]: tables[table] for table in self.tables}
+        for table, presence in self.update_gene_presence().items():
+            tables[table + "_presence"] = presence.to_dataframe()
+            tables[table + "_genes"] = presence.genes_dataframe()
+            sheets[self.gene_sheet_names[table][0]] = tables[table + "_presence"]
+            sheets[self.gene_sheet_names[table][1]] = tables[table + "_genes"]
+        for table in tables:
+            self.write_view(table, tables[table], appendable=not (table == "summary" and clusters is not None))
+        self.save()
+        if self.report_file:
+            write_excel(os.path.join(self.run_directory, self.report_file), sheets)
+
+        self.write_alleles(self.run_directory)
+
+        blocks = self.read_distance_blocks() if square_distances else []
+        if blocks:
+            DistanceMatrix.assemble(blocks, self.run_directory)
+        else:
+            for filename in [DistanceMatrix.data_file, DistanceMatrix.index_file, "distances.tsv"]:
+                if os.path.exists(os.path.join(self.run_directory, filename)):
+                    os.remove(os.path.join(self.run_directory, filename))
+
+    def view_files(self) -> List[str]:
+        """files of the cumulative views written by materialize"""
+        return [table + ".tsv" for table in self.tables] + [
+            table + suffix + ".tsv" for table in GENE_TABLES for suffix in ["_presence", "_genes"]
+        ] + [
+            self.report_file,
+            AlleleMatrix.data_file,
+            AlleleMatrix.index_file,
+            "alleles.tsv",
+            DistanceMatrix.data_file,
+            DistanceMatrix.index_file,
+            "distances.tsv",
+            "cluster_merges.tsv",
+        ]
+
+    def remove_views(self):
+        """remove the cumulative views left in the run directory (e.g. by a previous report generation)"""
+        for filename in self.view_files():
+            if filename and os.path.exists(os.path.join(self.run_directory, filename)):
+                os.remove(os.path.join(self.run_directory, filename))
+
+    def read_distance_blocks(self) -> List[DistanceMatrix]:
+        """distance blocks of all the partitions (empty if any partition with alleles has none)"""
+
+        blocks = []
+        for partition, path in zip(self.partitions, self.partition_paths()):
+            if not self.read_partition_allele_header(path):
+                continue
+            if "distances" not in partition:
+                return []
+            blocks.append(
+                DistanceMatrix.load(
+                    os.path.normpath(os.path.join(self.run_directory, partition["distances"]))
+                )
+            )
+
+        return blocks
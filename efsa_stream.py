@@ -0,0 +1,56 @@
+import queue
+import threading
+import time
+
+from typing import Any, Callable, Optional
+
+
+class BackgroundStage:
+    """
+    stage of a run that processes items (e.g. samples) in a background thread as soon as they are added
+
+    Items are processed one at a time, in the order they were added, by consume(item, *args), while the
+    thread that adds them carries on. close waits for the items left and raises the first error met, so
+    a failure in the background is not lost. The time spent processing (busy_seconds) and the time close
+    waited for the stage to finish (flush_seconds) are kept for the run metrics.
+    """
+
+    def __init__(self, consume: Callable, *args: Any) -> None:
+
+        self.consume = consume
+        self.args = args
+        self.items: "queue.Queue" = queue.Queue()
+        self.consumed = 0
+        self.busy_seconds = 0.0
+        self.flush_seconds = 0.0
+        self.error: Optional[BaseException] = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def add(self, item: Any):
+        self.items.put(item)
+
+    def run(self):
+        while True:
+            item = self.items.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue
+            start = time.perf_counter()
+            try:
+                self.consume(item, *self.args)
+                self.consumed += 1
+            except BaseException as error:
+                self.error = error
+            self.busy_seconds += time.perf_counter() - start
+
+    def close(self):
+        """wait for the items left (raising the first error of the stage, if any)"""
+
+        start = time.perf_counter()
+        self.items.put(None)
+        self.thread.join()
+        self.flush_seconds = time.perf_counter() - start
+        if self.error is not None:
+            raise self.error
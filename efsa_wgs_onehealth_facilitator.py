@@ -11,9 +11,25 @@ import os
 import argparse
 import textwrap
 import glob
+import subprocess
+import shutil
+import fcntl
+import concurrent.futures
 import datetime as datetime
+import numpy
 import pandas
-from efsa_parser import EfsaResults
+from efsa_parser import EfsaResults, parse_sample_records
+from efsa_alleles import AlleleMatrix, encode_alleles
+from efsa_cache import AnalysisCache, ResultCache
+from efsa_store import RunStore
+from efsa_distances import DistanceMatrix
+from efsa_genes import samples_with_genes
+from efsa_ledger import RunLedger
+from efsa_manifest import ResultManifest
+from efsa_metrics import RunMetrics
+from efsa_neighbours import query_profiles
+from efsa_query import TableIndex
+from efsa_stream import BackgroundStage
 
 version = "1.0.1"
 last_updated = "2024-10-30"
@@ -22,28 +38,88 @@ script_location = os.path.realpath(__file__)
 script_path = script_location.rsplit("/", 2)[0]
 efsa_workflow = script_path + "/onehealth.nf"
 python = sys.executable
+FICLONE = 0x40049409
+stage_fallbacks = {"copy": ["copy"], "reflink": ["reflink", "copy"], "hardlink": ["hardlink", "reflink", "copy"], "symlink": ["symlink", "copy"]}
 
 # functions ----------
 
-def distribute_fastq(fastq_directory, samples_info, outdir, only_reports):
-	""" This function distributes the different fastq files into separate directories """
+def reflink_file(source, destination):
+	""" This function creates a copy-on-write clone of a file (only supported by some filesystems, e.g. btrfs and xfs) """
+
+	with open(source, "rb") as infile:
+		with open(destination, "wb") as outfile:
+			try:
+				fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+			except OSError:
+				outfile.close()
+				os.remove(destination)
+				raise
+
+def stage_file(source, sample_dir, stage_mode):
+	""" This function stages a fastq file in the sample directory, falling back to the next available mode 
+	when the requested one is not supported (e.g. hardlinks across filesystems)
+	input: fastq file, sample directory, staging mode
+	output: staging mode that was used
+	"""
+
+	destination = sample_dir + "/" + os.path.basename(source)
+	if os.path.lexists(destination):
+		os.remove(destination)
+	for mode in stage_fallbacks[stage_mode]:
+		try:
+			if mode == "hardlink":
+				os.link(source, destination)
+			elif mode == "reflink":
+				reflink_file(source, destination)
+			elif mode == "symlink":
+				os.symlink(os.path.realpath(source), destination)
+			else:
+				shutil.copyfile(source, destination)
+			return mode
+		except OSError as error:
+			last_error = error
+	
+	raise last_error
+
+def stage_files(to_stage, stage_mode, stage_jobs):
+	""" This function stages all the fastq files of the run (in parallel if requested)
+	input: list of (fastq file, sample directory), staging mode, number of parallel staging jobs
+	output: dictionary with the number of files staged with each mode
+	"""
+
+	modes_used = {}
+	if stage_jobs > 1:
+		with concurrent.futures.ThreadPoolExecutor(max_workers = stage_jobs) as executor:
+			modes = list(executor.map(lambda task: stage_file(task[0], task[1], stage_mode), to_stage))
+	else:
+		modes = [stage_file(source, sample_dir, stage_mode) for source, sample_dir in to_stage]
+	for mode in modes:
+		if mode not in modes_used.keys():
+			modes_used[mode] = 0
+		modes_used[mode] += 1
+	
+	return modes_used
+
+def distribute_fastq(fastq_directory, samples_info, outdir, only_reports, stage_mode = "copy", stage_jobs = 1, metrics = None, ledger = None):
+	""" This function distributes the different fastq files into separate directories (the number of files and bytes 
+	staged are added to the run metrics, if any). With a run ledger, the samples it lists as staged (or further) are 
+	not staged again and the newly staged ones are recorded in it. """
 
 	sample_dirs = []
 	sample_names = {}
+	to_stage = []
 	
 	if fastq_directory != "":
-		for filename in glob.glob(fastq_directory + "/*"):
-			if "/" in filename:
-				filename = filename.split("/")[-1]
+		for path in glob.glob(fastq_directory + "/*"):
+			if not os.path.isfile(path):
+				continue
+			filename = path.split("/")[-1]
 			sample = filename.split("_")[0]
 			sample_dir = outdir + "/" + sample
 			if sample_dir not in sample_dirs:
 				sample_dirs.append(sample_dir)
 				sample_names[sample_dir] = sample
-				if not only_reports:
-					os.system("mkdir " + sample_dir)
-			if not only_reports:
-				os.system("cp " + fastq_directory + "/" + sample + "* " + sample_dir)
+			to_stage.append((path, sample_dir))
 	elif samples_info != "":
 		with open(samples_info) as infile:
 			lines = infile.readlines()
@@ -57,22 +133,266 @@ def distribute_fastq(fastq_directory, samples_info, outdir, only_reports):
 				if sample_dir not in sample_dirs:
 					sample_dirs.append(sample_dir)
 					sample_names[sample_dir] = sample
-					if not only_reports:
-						os.system("mkdir " + sample_dir)
-				if not only_reports:
-					os.system("cp " + fq1 + " " + sample_dir)
-					os.system("cp " + fq2 + " " + sample_dir)
+				to_stage.append((fq1, sample_dir))
+				to_stage.append((fq2, sample_dir))
+	
+	if not only_reports:
+		if ledger is not None:
+			to_stage = [(source, sample_dir) for source, sample_dir in to_stage if ledger.state(sample_names[sample_dir]) == ""]
+		for sample_dir in sample_dirs:
+			os.makedirs(sample_dir, exist_ok = True)
+		modes_used = stage_files(to_stage, stage_mode, stage_jobs)
+		if ledger is not None:
+			ledger.update(sorted(set([sample_names[sample_dir] for source, sample_dir in to_stage])), RunLedger.STAGED)
+		print("\tStaged " + str(len(to_stage)) + " fastq files (" + ", ".join([mode + ": " + str(modes_used[mode]) for mode in modes_used.keys()]) + ")")
+		if metrics is not None:
+			metrics.count("staging", files = len(to_stage), bytes = sum([os.path.getsize(source) for source, sample_dir in to_stage]), modes = modes_used)
    
 	return sample_dirs, sample_names
 
-def run_efsa_pipeline(sample_dir, nextflow_config, species):
-    """ This function runs the EFSA command line pipeline """
+def write_run_config(sample_dir, nextflow_config, cpus, memory):
+	""" This function writes a nextflow config that caps the resources available to the pipeline of one sample
+	input: sample directory, nextflow config, number of cpus and memory (GB) for this sample (0 = no cap)
+	output: filename of the new config
+	"""
+
+	run_config = sample_dir + "/facilitator_resources.config"
+	with open(run_config, "w") as outfile:
+		print("includeConfig '" + nextflow_config + "'", file = outfile)
+		print("executor {", file = outfile)
+		if cpus > 0:
+			print("\tcpus = " + str(cpus), file = outfile)
+		if memory > 0:
+			print("\tmemory = '" + str(int(memory * 1024)) + " MB'", file = outfile)
+		print("}", file = outfile)
+
+	return run_config
+
+def run_efsa_pipeline(sample_dir, nextflow_config, species, cpus = 0, memory = 0, log_file = "", indir = ".", outdir = ".", metrics = None, resume = False):
+	""" This function runs the EFSA command line pipeline. The exit code, elapsed time, cpu time and peak memory of 
+	nextflow (and the processes it waited for) are added to the run metrics, if any.
+	input: sample directory, nextflow config, species, optional resource caps, log file, input/output directories 
+	(relative to the sample directory), run metrics and whether to resume a previous nextflow run of this directory
+	output: exit code of nextflow
+	"""
+
+	if cpus > 0 or memory > 0:
+		nextflow_config = write_run_config(sample_dir, nextflow_config, cpus, memory)
+	cmd = "nextflow -C '" + nextflow_config + "' run " + efsa_workflow + " --readType='dual' --species='" + species + "' --indir '" + indir + "' --outdir '" + outdir + "'"
+	if resume:
+		cmd += " -resume"
+	print("\tRunning EFSA pipeline in " + sample_dir + " with the following command:\n\t " + cmd + "\n")
+	log = open(log_file, "w") if log_file != "" else None
+	start = datetime.datetime.now()
+	try:
+		with subprocess.Popen(cmd, shell = True, cwd = sample_dir, stdout = log, stderr = subprocess.STDOUT if log is not None else None) as process:
+			try:
+				pid, status, usage = os.wait4(process.pid, 0)
+			except BaseException:
+				process.kill()
+				raise
+			returned_value = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+			process.returncode = returned_value
+	finally:
+		if log is not None:
+			log.close()
+	if metrics is not None:
+		metrics.add_pipeline_run(sample_dir.split("/")[-1], returned_value, (datetime.datetime.now() - start).total_seconds(), usage)
+
+	return returned_value
+
+def run_queued_efsa_pipeline(sample_dir, nextflow_config, species, cpus, memory, log_file, metrics = None, ledger = None, resume = False):
+	""" This function runs the EFSA pipeline of a sample queued by run_efsa_pipelines. The sample is only marked as running 
+	in the run ledger (if any) once a worker picked it up, so the samples still waiting are not taken for interrupted 
+	analyses when a run is resumed.
+	output: exit code of nextflow
+	"""
+
+	if ledger is not None:
+		ledger.update([sample_dir.split("/")[-1]], RunLedger.RUNNING)
+
+	return run_efsa_pipeline(sample_dir, nextflow_config, species, cpus, memory, log_file, metrics = metrics, resume = resume)
+
+def run_efsa_pipelines(sample_dirs, nextflow_config, species, jobs, max_cpus, max_mem, metrics = None, ledger = None, resume = False, stream = None):
+	""" This function runs the EFSA pipeline of several samples at once from a pool of workers
+	that share a total cpu/memory budget (0 = no budget). The state of each sample is recorded in the run ledger 
+	(if any) as soon as it changes and each sample is handed to the background stage reading the results (if any) 
+	as soon as its pipeline finished.
+	input: list of sample directories, nextflow config, species, number of jobs, cpu and memory (GB) budget, run metrics, 
+	run ledger, whether to resume the previous nextflow runs and BackgroundStage reading the results
+	output: dictionary with the exit code of each sample directory
+	"""
+
+	run_status = {}
+	if len(sample_dirs) == 0:
+		return run_status
+
+	jobs = max(1, min(jobs, len(sample_dirs)))
+	if max_cpus > 0:
+		jobs = min(jobs, max_cpus)
+		cpus = max_cpus // jobs
+	else:
+		cpus = 0
+	if max_mem > 0:
+		memory = max_mem / jobs
+	else:
+		memory = 0
+	print("\tRunning " + str(len(sample_dirs)) + " samples with " + str(jobs) + " concurrent job(s)" + (" (" + str(cpus) + " cpus each)" if cpus > 0 else "") + (" (" + str(round(memory, 2)) + " GB each)" if memory > 0 else ""))
+
+	done = 0
+	start = datetime.datetime.now()
+	with concurrent.futures.ThreadPoolExecutor(max_workers = jobs) as executor:
+		futures = {}
+		for directory in sample_dirs:
+			log_file = directory + "/nextflow_run.log" if jobs > 1 else ""
+			futures[executor.submit(run_queued_efsa_pipeline, directory, nextflow_config, species, cpus, memory, log_file, metrics, ledger, resume)] = directory
+		try:
+			for future in concurrent.futures.as_completed(futures):
+				directory = futures[future]
+				try:
+					run_status[directory] = future.result()
+				except OSError as error:
+					print("\tCould not launch the EFSA pipeline for " + directory + ": " + str(error))
+					run_status[directory] = -1
+				if ledger is not None:
+					ledger.finish(directory.split("/")[-1], run_status[directory])
+				if stream is not None:
+					stream.add(directory)
+				done += 1
+				print("\t[" + str(done) + "/" + str(len(sample_dirs)) + "] " + directory.split("/")[-1] + " finished with exit code " + str(run_status[directory]) + " (elapsed: " + str(datetime.datetime.now() - start) + ")")
+		except BaseException:
+			# interrupted: the samples still queued are not started (and stay staged in the ledger)
+			for future in futures:
+				future.cancel()
+			raise
+
+	return run_status
+
+def sample_fastq_files(sample_dir):
+	""" This function lists the fastq files staged in a sample directory """
+
+	return sorted([path for path in glob.glob(sample_dir + "/*") if os.path.isfile(path) and path.endswith((".fastq.gz", ".fq.gz", ".fastq", ".fq"))])
 
-    cmd = "cd " + sample_dir + "; nextflow -C '" + nextflow_config + "' run " + efsa_workflow + " --readType='dual' --species='" + species + "' --indir '.' --outdir '.'; cd ../../.."
-    print("\tRunning EFSA pipeline with the following command:\n\t",cmd,"\n")
-    returned_value = os.system(cmd)
+def restore_cached_analyses(analysis_cache, sample_dirs, sample_names):
+	""" This function restores the EFSA outputs of the samples whose reads were already analysed
+	input: AnalysisCache, list of sample directories, dictionary with sample directory -> sample name
+	output: dictionary with the cache key of each sample directory, list of sample directories that still have to be analysed
+	"""
+
+	keys = {}
+	to_run = []
+	for directory in sample_dirs:
+		fastq_files = sample_fastq_files(directory)
+		if len(fastq_files) == 0:
+			to_run.append(directory)
+			continue
+		keys[directory] = analysis_cache.key(fastq_files)
+		if not analysis_cache.restore(keys[directory], directory, sample_names[directory]):
+			to_run.append(directory)
+	print("\tReused the cached analysis of " + str(len(sample_dirs) - len(to_run)) + " sample(s)")
+
+	return keys, to_run
 
-    return returned_value
+def find_batch_output_owner(result_dir, samples):
+	""" This function finds the sample to which an EFSA output folder of a batch run belongs
+	input: EFSA output folder, list of sample names
+	output: sample name (empty if it could not be identified)
+	"""
+
+	hashed_results = result_dir + "/_hashed_results.tsv"
+	if os.path.exists(hashed_results):
+		with open(hashed_results) as infile:
+			infile.readline()
+			sample = infile.readline().split("\t")[0].split("_contigs.fa")[0]
+			if sample in samples:
+				return sample
+
+	owner = ""
+	for root, dirs, files in os.walk(result_dir):
+		dirs[:] = [d for d in dirs if not d.startswith("work")]
+		for filename in files + dirs:
+			for sample in samples:
+				if filename.startswith(sample) and len(sample) > len(owner):
+					owner = sample
+	
+	return owner
+
+def split_batch_outputs(batch_outdir, sample_names):
+	""" This function moves the EFSA output folders of a batch run to the respective sample directories
+	input: output directory of the batch run, dictionary with sample directory -> sample name
+	output: list of sample directories that received an EFSA output folder
+	"""
+
+	sample_to_dir = {sample_names[directory]: directory for directory in sample_names.keys()}
+	assigned = []
+	for result_dir in sorted(glob.glob(batch_outdir + "/*/")):
+		result_dir = result_dir.rstrip("/")
+		folder = result_dir.split("/")[-1]
+		if folder.startswith("work"):
+			continue
+		sample = find_batch_output_owner(result_dir, sample_to_dir.keys())
+		if sample == "":
+			print("\tCould not identify the sample of the batch output " + result_dir + "... it will be kept in the batch folder.")
+			continue
+		destination = sample_to_dir[sample] + "/" + folder
+		if os.path.exists(destination):
+			destination = destination + "_batch"
+		os.replace(result_dir, destination)
+		assigned.append(sample_to_dir[sample])
+	
+	return assigned
+
+def run_efsa_pipeline_batch(run_dir, sample_dirs, sample_names, nextflow_config, species, max_cpus, max_mem, metrics = None, ledger = None, resume = False, stream = None):
+	""" This function runs the EFSA pipeline once for all the samples of the run and splits the outputs back 
+	into the respective sample directories (which are then handed to the background stage reading the results, if any)
+	input: run directory, list of sample directories, dictionary with sample directory -> sample name, nextflow config, 
+	species, cpu and memory (GB) budget, run metrics, run ledger, whether to resume the previous batch run and 
+	BackgroundStage reading the results
+	output: dictionary with the exit code of each sample directory
+	"""
+
+	batch_dir = run_dir + "/batch"
+	# inputs and outputs of a previous (interrupted) batch run, so that only these samples are analysed
+	for folder in ["input", "output"]:
+		if os.path.exists(batch_dir + "/" + folder):
+			shutil.rmtree(batch_dir + "/" + folder)
+	os.makedirs(batch_dir + "/input", exist_ok = True)
+	os.makedirs(batch_dir + "/output", exist_ok = True)
+	# the inputs are named after their sample (and not the original fastq files), so the outputs can be matched back to it
+	inputs = {}
+	for directory in sample_dirs:
+		for filename in sorted(os.listdir(directory)):
+			if filename.endswith((".fastq.gz", ".fq.gz", ".fastq", ".fq")):
+				link = sample_names[directory] + "_" + filename.split("_", 1)[-1]
+				if link in inputs:
+					sys.exit(inputs[link] + " and " + directory + "/" + filename + " would both be analysed as " + link + " in the batch run... I cannot proceed!")
+				inputs[link] = directory + "/" + filename
+				os.symlink(os.path.realpath(directory + "/" + filename), batch_dir + "/input/" + link)
+
+	if ledger is not None:
+		ledger.update([sample_names[directory] for directory in sample_dirs], RunLedger.RUNNING)
+	returned_value = run_efsa_pipeline(batch_dir, nextflow_config, species, max_cpus, max_mem, indir = "input", outdir = "output", metrics = metrics, resume = resume)
+	assigned = split_batch_outputs(batch_dir + "/output", sample_names)
+	run_status = {}
+	for directory in sample_dirs:
+		if directory in assigned:
+			run_status[directory] = returned_value
+		else:
+			run_status[directory] = returned_value if returned_value != 0 else -1
+		if ledger is not None:
+			ledger.finish(sample_names[directory], run_status[directory])
+		if stream is not None:
+			stream.add(directory)
+	
+	return run_status
+
+def clear_incomplete_outputs(sample_dir):
+	""" This function removes the EFSA output folders left in a sample directory by an interrupted or failed analysis 
+	(the nextflow work folder is kept, so that the analysis can be resumed) """
+
+	for folder in os.listdir(sample_dir):
+		if os.path.isdir(sample_dir + "/" + folder) and not folder.startswith(("work", ".")):
+			shutil.rmtree(sample_dir + "/" + folder)
 
 def join_df(old_df,new_df):
 	""" This function joins two dataframes
@@ -87,48 +407,138 @@ def join_df(old_df,new_df):
 
 	return final_df
 	
-def join_allele_matrices(sample_dirs, previous_run):
-	""" This function joins all allele matrices  """
+def read_allele_profile(filename):
+	""" This function reads the allele hash profile of a sample
+	input: _hashed_results.tsv filename
+	output: list with the column names, list of rows with the sample name (without '_contigs.fa') in the first column
+	"""
+
+	with open(filename) as infile:
+		header = infile.readline().rstrip("\n").split("\t")
+		rows = []
+		for line in infile:
+			row = line.rstrip("\n").split("\t")
+			if len(row) > 1:
+				row[0] = row[0].split("_contigs.fa")[0]
+				rows.append(row)
+
+	return header, rows
+
+def encode_allele_profile(filename):
+	""" This function reads the allele hash profile of a sample with the alleles encoded as integers
+	input: _hashed_results.tsv filename
+	output: list with the column names, list with the sample names, numpy array with the alleles of each sample, 
+	dictionary with the calls that are not a hash (e.g. "-"), kept as they were (sample -> locus -> call)
+	"""
+
+	header, rows = read_allele_profile(filename)
+	values = numpy.zeros((len(rows), len(header) - 1), dtype = AlleleMatrix.dtype)
+	missing_calls = {}
+	for i, row in enumerate(rows):
+		values[i], calls = encode_alleles(row[1:])
+		if len(calls) > 0:
+			missing_calls[row[0]] = {header[position + 1]: call for position, call in calls.items()}
+
+	return header, [row[0] for row in rows], values, missing_calls
+
+def consume_sample_results(directory, cache, manifest, profiles, records):
+	""" This function reads the results of a sample as soon as its EFSA pipeline finished (with '--stream-reports'), while 
+	the other samples are still being analysed: its output folder is added to the result manifest, its allele profile is 
+	encoded and its reports are parsed (into the result cache, unless they were already cached), so the report stages only 
+	have to concatenate them.
+	input: sample directory, ResultCache, ResultManifest, dictionary with the encoded allele profile of each sample directory 
+	and dictionary with the report records of each sample (both filled here)
+	"""
+
+	sample = directory.split("/")[-1]
+	manifest.samples[directory] = ResultManifest.scan_sample(directory)
+	filenames = manifest.files(directory, "_hashed_results.tsv")
+	if len(filenames) == 1:
+		profiles[directory] = encode_allele_profile(filenames[0])
+	filenames = manifest.files(directory, "_parseresults.json")
+	if len(filenames) == 1:
+		data = cache.get(sample, "reports", filenames[0], manifest.stat(filenames[0]))
+		if data is None:
+			data = dict(zip(["found", "records"], parse_sample_records(sample, os.path.dirname(filenames[0]))))
+			cache.put(sample, "reports", filenames[0], data)
+		records[sample] = (data["found"], data["records"])
+
+def join_allele_matrices(sample_dirs, previous_run, manifest = None, encoded_profiles = None):
+	""" This function joins all allele matrices of the run
+	All the profiles are validated against the columns of the first one (or of the previous run) and checked 
+	for samples that were already present before the final matrix is built at once, so the cost grows linearly 
+	with the number of samples. Only the loci and sample names of the previous run are read. The profiles are located 
+	through the result manifest of the run (scanned if not provided); the ones already encoded (encoded_profiles, e.g. by 
+	the background stage of '--stream-reports') are not read again.
+	output: AlleleMatrix with the samples of this run
+	"""
 	
+	if manifest is None:
+		manifest = ResultManifest.scan(sample_dirs)
+	if encoded_profiles is None:
+		encoded_profiles = {}
+	header = []
+	columns = None
+	seen = set()
+	samples = []
+	profiles = []
+	missing_calls = {}
 	if previous_run != "":
-		df = pandas.read_table(previous_run + "/alleles.tsv", dtype=str)
-	else:
-		df = pandas.DataFrame()
+		previous = RunStore.open(previous_run)
+		header = previous.allele_header()
+		if len(header) > 0:
+			columns = set(header)
+		seen.update(previous.allele_samples())
 
 	for directory in sample_dirs:
-		counter = 0
-		for filename in glob.glob(directory + "/*/_hashed_results.tsv"):
-			counter += 1
-		if counter == 0:
+		filenames = manifest.files(directory, "_hashed_results.tsv")
+		if len(filenames) == 0:
 			print("\tNo allele hash file found for " + directory)
-		elif counter > 1:
+		elif len(filenames) > 1:
 			print("\tMultiple allele hash files found for the same sample... please check run outputs for " + directory)
 		else:
-			if len(df.columns) == 0:
-				df = pandas.read_table(filename, dtype=str)
-				df[df.columns[0]][0] = df[df.columns[0]][0].split("_contigs.fa")[0]
-			else:
-				new_df = pandas.read_table(filename, dtype = str)
-				new_df[new_df.columns[0]][0] = new_df[new_df.columns[0]][0].split("_contigs.fa")[0]
-				if len(set(df.columns) - set(new_df.columns)) == 0 and len(set(new_df.columns) - set(df.columns)) == 0:
-					if new_df[new_df.columns[0]][0] not in df[df.columns[0]].values.tolist():
-						df = join_df(df,new_df)
-					else:
-						sys.exit(str(new_df[new_df.columns[0]][0]) + " was already present in the previous table! Cannot proceed!")
-				else:
-					sys.exit("Column names do not match between the different files! Cannot proceed!")
+			new_header, new_samples, new_values, new_calls = encoded_profiles[directory] if directory in encoded_profiles else encode_allele_profile(filenames[0])
+			if columns is None:
+				header = new_header
+				columns = set(header)
+			elif set(new_header) != columns:
+				sys.exit("Column names do not match between the different files! Cannot proceed!")
+			if new_header != header:
+				positions = {column: i for i, column in enumerate(new_header[1:])}
+				new_values = new_values[:, [positions[column] for column in header[1:]]]
+			for name, values in zip(new_samples, new_values):
+				if name in seen:
+					sys.exit(str(name) + " was already present in the previous table! Cannot proceed!")
+				seen.add(name)
+				samples.append(name)
+				profiles.append(values)
+			missing_calls.update(new_calls)
 	
-	return df
+	if len(profiles) > 0:
+		matrix = AlleleMatrix(samples, header[1:], numpy.vstack(profiles), header[0], missing_calls)
+	else:
+		matrix = AlleleMatrix.empty(header[1:], header[0] if len(header) > 0 else "FILE")
+	
+	return matrix
 
-def join_reports_efsa_parser(out_dir, sample_dirs, run_name, species, species_code):
-	""" This function joins the reports of a given run with the efsa parser """
+def join_reports_efsa_parser(sample_dirs, parse_jobs = 1, cache = None, manifest = None, records = None):
+	""" This function joins the reports of a given run with the efsa parser (using parse_jobs worker processes). 
+	Samples already parsed (records, e.g. by the background stage of '--stream-reports') or found in the result cache 
+	(if any) are not parsed again.
+	input: list of sample directories, number of worker processes, result cache, result manifest (scanned if not provided), 
+	dictionary with the report records of the samples already parsed
+	output: dictionary with the samples without results, dictionary with the summary, mlst, amr and pathotypes tables 
+	(None if no sample has results)
+	"""
 	
+	if manifest is None:
+		manifest = ResultManifest.scan(sample_dirs)
 	dir_to_sample = {}
 	failed = {}
 	for directory in sample_dirs:
 		counter = 0
 		sample_name = directory.split("/")[-1]
-		for filename in glob.glob(directory + "/*/_parseresults.json"):
+		for filename in manifest.files(directory, "_parseresults.json"):
 			sample_run = filename.split("/")[-2]
 			sample_dir = directory + "/" + sample_run
 			counter += 1
@@ -137,19 +547,34 @@ def join_reports_efsa_parser(out_dir, sample_dirs, run_name, species, species_co
 		elif counter == 0:
 			failed[sample_name] = directory
 	if len(dir_to_sample.keys()) > 0:
-		output_file = out_dir + "/" + run_name + "/" + str(species_code[species]) + "_" + run_name + "_report.xlsx"
-		outputs_directory = out_dir + "/" + run_name
-		results = EfsaResults(dir_to_sample, outputs_directory, output_file)
-		results.parse_all_results()
-		results.merge_output()
-		run_successful_samples = True
+		results = EfsaResults(dir_to_sample, "", "", workers = parse_jobs)
+		cached = {sample: records[sample] for sample in dir_to_sample.keys() if records is not None and sample in records}
+		if cache is not None:
+			for sample, sample_dir in dir_to_sample.items():
+				if sample in cached:
+					continue
+				data = cache.get(sample, "reports", sample_dir + "/_parseresults.json", manifest.stat(sample_dir + "/_parseresults.json"))
+				if data is not None:
+					cached[sample] = (data["found"], data["records"])
+		results.parse_all_results(cached)
+		if cache is not None:
+			for sample, (found, records) in results.parsed_results.items():
+				if sample not in cached:
+					cache.put(sample, "reports", dir_to_sample[sample] + "/_parseresults.json", {"found": found, "records": records})
+		summary, pathotypes, amr, mlst = results.process_output(merge_existing = False)
+		reports = {"summary": summary, "mlst": mlst, "amr": amr, "pathotypes": pathotypes}
 	else:
-		run_successful_samples = False
+		reports = None
 
-	return failed, run_successful_samples
+	return failed, reports
 
-def prepare_final_reports(out_dir, run_name, failed, previous_run, run_successful_samples, species, species_code):
-	""" This function adds QC information to the summary report """
+def prepare_final_reports(failed, store, reports, lazy_views, metrics = None, manifest = None, square_distances = False):
+	""" This function adds QC information to the summary report, writes the reports of this run to its partition 
+	of the store and, unless lazy_views is set, the cumulative reports of all the runs in the store, with the tables 
+	of this run passed on in memory instead of read back from its partition (the number of rows written is added to 
+	the run metrics, if any). The logs of the failed samples are located through the result 
+	manifest of the run (scanned if not provided). The square distance matrix of all the samples is only written 
+	with square_distances. """
 
 	passed_qc = []
 	failed_df_tsv = {}
@@ -157,8 +582,10 @@ def prepare_final_reports(out_dir, run_name, failed, previous_run, run_successfu
 	failed_df_tsv["QC_VOTE"] = []
 
 	if len(failed) > 0:
+		if manifest is None:
+			manifest = ResultManifest.scan(list(failed.values()))
 		for sample in failed.keys():
-			for filename in glob.glob(failed[sample] + "/*/_logging.json"):
+			for filename in manifest.files(failed[sample], "_logging.json"):
 				with open(filename) as log_info:
 					lines = log_info.readlines()
 					for line in lines:
@@ -171,17 +598,11 @@ def prepare_final_reports(out_dir, run_name, failed, previous_run, run_successfu
 	else:
 		failed_df_tsv = pandas.DataFrame()
 
-	if run_successful_samples:
-		summary_tsv = pandas.read_table(out_dir + "/" + run_name + "/summary.tsv")
-		mlst_tsv = pandas.read_table(out_dir + "/" + run_name + "/mlst.tsv")
-		try:
-			amr_tsv = pandas.read_table(out_dir + "/" + run_name + "/amr.tsv")
-		except pandas.errors.EmptyDataError:
-			amr_tsv = pandas.DataFrame()
-		try:
-			pathotyping_tsv = pandas.read_table(out_dir + "/" + run_name + "/pathotypes.tsv")
-		except pandas.errors.EmptyDataError:
-			pathotyping_tsv = pandas.DataFrame()
+	if reports is not None:
+		summary_tsv = reports["summary"]
+		mlst_tsv = reports["mlst"]
+		amr_tsv = reports["amr"]
+		pathotyping_tsv = reports["pathotypes"]
 		
 		for sample in summary_tsv["Analysis_ID"].values.tolist():
 			passed_qc.append("PASS")
@@ -197,49 +618,16 @@ def prepare_final_reports(out_dir, run_name, failed, previous_run, run_successfu
 		amr_tsv = pandas.DataFrame()
 		pathotyping_tsv = pandas.DataFrame()
 
-	if previous_run != "":
-		previous_summary = pandas.read_table(previous_run + "/summary.tsv")
-		final_summary = join_df(previous_summary, summary_tsv)
-		try:
-			previous_mlst = pandas.read_table(previous_run + "/mlst.tsv")
-			if mlst_tsv.empty:
-				final_mlst = previous_mlst
-			else:
-				final_mlst = join_df(previous_mlst, mlst_tsv)
-		except pandas.errors.EmptyDataError:
-			final_mlst = mlst_tsv
-		try:
-			previous_amr = pandas.read_table(previous_run + "/amr.tsv")
-			if amr_tsv.empty:
-				final_amr = previous_amr
-			else:
-				final_amr = join_df(previous_amr, amr_tsv)
-		except pandas.errors.EmptyDataError:
-			final_amr = amr_tsv
-		try:
-			previous_pathotyping = pandas.read_table(previous_run + "/pathotypes.tsv")
-			if pathotyping_tsv.empty:
-				final_pathotyping = previous_pathotyping
-			else:
-				final_pathotyping = join_df(previous_pathotyping, pathotyping_tsv)
-		except pandas.errors.EmptyDataError:
-			final_pathotyping = pathotyping_tsv
-	else:
-		final_summary = summary_tsv
-		final_mlst = mlst_tsv
-		final_amr = amr_tsv
-		final_pathotyping = pathotyping_tsv
+	tables = {"summary": summary_tsv, "mlst": mlst_tsv, "amr": amr_tsv, "pathotypes": pathotyping_tsv}
+	store.write_partition_tables(tables)
+	store.save()
+	if metrics is not None:
+		metrics.count("final_reports", rows = {table: len(tables[table].index) for table in tables.keys()})
 	
-	final_summary.to_csv(out_dir + "/" + str(run_name) + "/summary.tsv", index = False, header=True, sep ="\t")
-	final_mlst.to_csv(out_dir + "/" + str(run_name) + "/mlst.tsv", index = False, header=True, sep ="\t")
-	final_amr.to_csv(out_dir + "/" + str(run_name) + "/amr.tsv", index = False, header=True, sep ="\t")
-	final_pathotyping.to_csv(out_dir + "/" + str(run_name) + "/pathotypes.tsv", index = False, header=True, sep ="\t")
-
-	with pandas.ExcelWriter(out_dir + "/" + str(run_name) + "/" + str(species_code[species]) + "_" + run_name + "_report.xlsx") as writer:
-		final_summary.to_excel(writer, sheet_name = "Summary", index = False)
-		final_mlst.to_excel(writer, sheet_name = "MLST", index = False)
-		final_amr.to_excel(writer, sheet_name = "AMR", index = False)
-		final_pathotyping.to_excel(writer, sheet_name = "Pathotypes", index = False)
+	if lazy_views:
+		store.remove_views()
+	else:
+		store.materialize(square_distances, tables)
 		
 def read_json_efsa(report_file, strain):
 	""" This function converts EFSA json report into a pandas dataframe
@@ -283,9 +671,135 @@ def read_json_efsa(report_file, strain):
 	
 	return mx
 
+def materialize_run(argv):
+	""" This function writes the cumulative reports of a run from the partitions listed in its store manifest """
+
+	parser = argparse.ArgumentParser(prog="efsa_wgs_onehealth_facilitator.py materialize", description="Write the cumulative reports (TSV, Excel, \
+									allele matrix and square distance matrix) of a run from the partitions listed in its store manifest (e.g. a run created \
+									with '--lazy-views').")
+	parser.add_argument("run_directory", type=str, help="FULL PATH to the run directory.")
+	parser.add_argument("--distances-tsv", dest="distances_tsv", required=False, action="store_true", help="Also export the distance matrix to distances.tsv.")
+	args = parser.parse_args(argv)
+
+	if not os.path.exists(args.run_directory + "/" + RunStore.manifest_file):
+		sys.exit("No store manifest found in " + args.run_directory + "... I cannot proceed!")
+	print("Writing the cumulative reports of " + args.run_directory + "...")
+	RunStore.open(args.run_directory).materialize(square_distances = True)
+	if args.distances_tsv and DistanceMatrix.exists(args.run_directory):
+		DistanceMatrix.load(args.run_directory).to_tsv(args.run_directory + "/distances.tsv")
+
+def result_cache(argv):
+	""" This function shows or purges the result cache of a run """
+
+	parser = argparse.ArgumentParser(prog="efsa_wgs_onehealth_facilitator.py cache", description="Show the result cache of a run (the parsed results \
+									of its samples reused by '--only-reports') or purge it.")
+	parser.add_argument("run_directory", type=str, help="FULL PATH to the run directory.")
+	parser.add_argument("--purge", dest="purge", required=False, action="store_true", help="Remove all the entries of the cache.")
+	parser.add_argument("--max-size", dest="max_size", default=0, type=float, help="Remove the least recently used entries until the cache \
+						takes at most this size (in GB).")
+	args = parser.parse_args(argv)
+
+	cache = ResultCache(args.run_directory)
+	if args.purge:
+		cache.purge()
+		print("Purged the result cache of " + args.run_directory)
+		return
+	if args.max_size > 0:
+		cache.max_bytes = int(args.max_size * 1024**3)
+		cache.save()
+
+	print("Result cache of " + args.run_directory + " (" + cache.directory + ")")
+	if cache.invalidated:
+		print("\tThe cache was written by another parser version and will be dropped by the next report generation.")
+	print("\tVersion: parser " + str(cache.version()["parser"]))
+	print("\tEntries: " + str(len(cache.entries)) + "".join(", " + str(count) + " " + kind for kind, count in sorted(cache.summary().items())))
+	print("\tSize: " + str(round(cache.size() / 1024**2, 2)) + " MB (limit: " + str(round(cache.max_bytes / 1024**3, 2)) + " GB)")
+
+def nearest_samples(argv):
+	""" This function reports the samples of a run (and the runs it builds on) closest to new allele profiles or to 
+	samples already in the run """
+
+	parser = argparse.ArgumentParser(prog="efsa_wgs_onehealth_facilitator.py neighbours", description="Report the k samples of a run (including the \
+									previous runs it builds on) with the smallest allele distance to new allele profiles (_hashed_results.tsv) or to samples \
+									of the run. The neighbour index of the run is built the first time it is needed and reused afterwards.")
+	parser.add_argument("run_directory", type=str, help="FULL PATH to the run directory.")
+	parser.add_argument("--profiles", dest="profiles", nargs="+", default=[], type=str, help="_hashed_results.tsv file(s) of the new sample(s).")
+	parser.add_argument("--samples", dest="samples", nargs="+", default=[], type=str, help="Name(s) of sample(s) of the run.")
+	parser.add_argument("-k", dest="k", default=10, type=int, help="Number of closest samples reported for each query (default: 10).")
+	parser.add_argument("--max-distance", dest="max_distance", default=None, type=int, help="Only report samples within this allele distance.")
+	parser.add_argument("--output", dest="output", default="", type=str, help="TSV file for the results (default: standard output).")
+	args = parser.parse_args(argv)
+
+	if len(args.profiles) == 0 and len(args.samples) == 0:
+		sys.exit("Please indicate at least one allele profile or sample!")
+	if args.k < 1:
+		sys.exit("Please indicate a valid number of samples!")
+	store = RunStore.open(args.run_directory)
+	indexes = store.update_neighbour_indexes()
+	if len(indexes) == 0:
+		sys.exit("No allele profiles found in " + args.run_directory + "... I cannot proceed!")
+
+	queries = {}
+	for filename in args.profiles:
+		header, rows = read_allele_profile(filename)
+		for row in rows:
+			queries[row[0]] = (header[1:], encode_alleles(row[1:])[0])
+	alleles = store.read_alleles(args.samples)
+	for sample in args.samples:
+		if sample not in alleles.samples:
+			sys.exit(sample + " was not found in " + args.run_directory + "... I cannot proceed!")
+	for sample, profile in zip(alleles.samples, alleles.values):
+		queries[sample] = (alleles.loci, profile)
+
+	results = pandas.DataFrame(query_profiles(indexes, queries, args.k, args.max_distance, exclude_self = True), columns = ["query", "rank", "sample", "distance", "shared_loci"])
+	results.to_csv(args.output if args.output != "" else sys.stdout, index = False, sep = "\t")
+
+def query_run(argv):
+	""" This function reports the rows of the summary, mlst, amr and pathotypes tables of a run for the samples 
+	matching the filters, using the indexes of the run tables (built the first time and whenever a table changes) 
+	and the gene presence matrices of the run store """
+
+	parser = argparse.ArgumentParser(prog="efsa_wgs_onehealth_facilitator.py query", description="Report the rows of the cumulative summary, \
+									mlst, amr and pathotypes tables of a run for the samples matching all the filters (any of the values given for \
+									each filter). The tables are indexed the first time they are queried, so the following queries only read the \
+									matching rows.")
+	parser.add_argument("run_directory", type=str, help="FULL PATH to the run directory.")
+	parser.add_argument("--samples", dest="samples", nargs="+", default=[], type=str, help="Analysis_ID(s) of the sample(s).")
+	parser.add_argument("--st", dest="st", nargs="+", default=[], type=str, help="Sequence type(s) (ST).")
+	parser.add_argument("--serotype", dest="serotype", nargs="+", default=[], type=str, help="Serotype(s).")
+	parser.add_argument("--qc", dest="qc", nargs="+", default=[], type=str, help="QC_VOTE (PASS or FAIL, which matches any failure).")
+	parser.add_argument("--species", dest="species", nargs="+", default=[], type=str, help="Species detected by Mash (MashSpeciesDetected, regardless of case).")
+	parser.add_argument("--gene", dest="genes", nargs="+", default=[], type=str, help="AMR or pathotype gene(s) or AMR variant(s) (key column of amr.tsv) carried by the samples.")
+	parser.add_argument("--all-genes", dest="all_genes", required=False, action="store_true", help="Only report the samples carrying all \
+						the genes given in '--gene' (default: any of them).")
+	parser.add_argument("--output", dest="output", default="", type=str, help="Prefix of the TSV files for the results (<prefix>summary.tsv, \
+						<prefix>mlst.tsv, <prefix>amr.tsv and <prefix>pathotypes.tsv). Default: standard output.")
+	args = parser.parse_args(argv)
+
+	if not os.path.exists(TableIndex.table_file(args.run_directory, "summary")):
+		sys.exit("No summary.tsv found in " + args.run_directory + " (for runs created with '--lazy-views', please run materialize first)... I cannot proceed!")
+	index = TableIndex.open(args.run_directory)
+	samples = index.select(args.samples, st = args.st, serotype = args.serotype, qc = args.qc, species = args.species)
+	if len(args.genes) > 0:
+		carriers = samples_with_genes(RunStore.open(args.run_directory).update_gene_presence(persist = False), args.genes, args.all_genes)
+		samples = [sample for sample in samples if sample in carriers]
+	print(str(len(samples)) + " sample(s) found in " + args.run_directory, file = sys.stderr)
+	for table, rows in index.query(samples).items():
+		if args.output != "":
+			rows.to_csv(args.output + table + ".tsv", index = False, sep = "\t")
+		else:
+			print("# " + table)
+			rows.to_csv(sys.stdout, index = False, sep = "\t")
+
+subcommands = {"materialize": materialize_run, "cache": result_cache, "neighbours": nearest_samples, "query": query_run}
+
 # running the pipeline	----------
 
 def main():
+
+	if len(sys.argv) > 1 and sys.argv[1] in subcommands.keys():
+		subcommands[sys.argv[1]](sys.argv[2:])
+		return
     
 	# argument options	----------
     
@@ -328,6 +842,51 @@ def main():
 					 	will be added to the reports of this previous run). Please do not include a final slash '/' in the directory name.")
 	group0.add_argument("--only-reports", dest="only_reports", required=False, action="store_true", help="[OPTIONAL] Set only if you already have a run and just want to generate the \
 						reports. This argument must be used carefully as it assumes a folder structure similar to the one generated by the script.")
+	group0.add_argument("--resume", dest="resume", required=False, action="store_true", help="[OPTIONAL] Resume an interrupted run (same command line). \
+						Samples already analysed are skipped, the others are staged and/or analysed again (resuming the previous nextflow run of the sample, \
+						so finished steps are not repeated) and the reports are then generated as usual. The state of each sample is kept in <run>/run_state.json.")
+
+	group0.add_argument("--lazy-views", dest="lazy_views", required=False, action="store_true", help="[OPTIONAL] Only write the results of the samples of this \
+						run (to <run>/partition/) and the store manifest listing the runs it builds on, without the cumulative reports. These can be written \
+						later with 'efsa_wgs_onehealth_facilitator.py materialize <run directory>'.")
+	group0.add_argument("--stage-mode", dest="stage_mode", default="copy", choices=["copy", "hardlink", "reflink", "symlink"], help="[OPTIONAL] How the fastq \
+						files are staged in the run directory (default: copy). 'hardlink' and 'reflink' do not use extra disk space, 'symlink' points to the \
+						original files. If the requested mode is not supported, the script falls back to the next one (hardlink > reflink > copy, \
+						symlink > copy).")
+	group0.add_argument("--stage-jobs", dest="stage_jobs", default=1, type=int, help="[OPTIONAL] Number of fastq files staged at the same time \
+						(default: 1). Mostly useful when the files have to be copied.")
+	group0.add_argument("--parse-jobs", dest="parse_jobs", default=1, type=int, help="[OPTIONAL] Number of worker processes used to parse the results \
+						of the samples when generating the reports (default: 1). Mostly useful with '--only-reports' on runs with many samples.")
+	group0.add_argument("--stream-reports", dest="stream_reports", required=False, action="store_true", help="[OPTIONAL] Read the results of each \
+						sample in the background as soon as its EFSA pipeline finished, while the other samples are analysed: its allele profile is encoded \
+						and its reports are parsed and kept in memory, so the allele matrix and the reports of the run are built from them once the last sample \
+						finished, without reading the result files again. Ignored with '--only-reports'.")
+	group0.add_argument("--profile", dest="profile", required=False, action="store_true", help="[OPTIONAL] Profile the report stages (allele matrix, \
+						parsing of the results and final reports) with cProfile. The statistics are written to <run>/profiles/<stage>.prof.")
+
+	group1 = parser.add_argument_group("Resources", "Scheduling of the EFSA pipeline runs")
+	group1.add_argument("-j", "--jobs", dest="jobs", default=1, type=int, help="[OPTIONAL] Number of samples analysed at the same time (default: 1). \
+						The output of each nextflow run is written to 'nextflow_run.log' in the sample folder when more than one job is used.")
+	group1.add_argument("--max-cpus", dest="max_cpus", default=0, type=int, help="[OPTIONAL] Total number of cpus shared by all concurrent jobs (default: 0, \
+						i.e. no limit). Each job will be limited to max-cpus/jobs cpus.")
+	group1.add_argument("--max-mem", dest="max_mem", default=0, type=float, help="[OPTIONAL] Total memory (in GB) shared by all concurrent jobs (default: 0, \
+						i.e. no limit). Each job will be limited to max-mem/jobs GB.")
+	group1.add_argument("--analysis-cache", dest="analysis_cache", default="", type=str, help="[OPTIONAL] FULL PATH to a folder (shared by all the runs) \
+						where the outputs of the EFSA pipeline are kept by fingerprint of the fastq files, species and workflow/config files. Samples whose \
+						reads were already analysed, even under another name, are not analysed again and get a copy of the previous outputs instead.")
+	group1.add_argument("--batch", dest="batch", required=False, action="store_true", help="[OPTIONAL] Run the EFSA pipeline only once for all the samples \
+						of the run (a single nextflow invocation) instead of once per sample. The fastq files are given to it named after their sample \
+						(<sample>_<rest of the file name>) and the outputs are then moved to the respective sample folders. '--jobs' is ignored in this mode, while '--max-cpus' and '--max-mem' are applied to the single nextflow run.")
+
+	group2 = parser.add_argument_group("Distances", "Allele distances between all the samples (this run and previous runs)")
+	group2.add_argument("--distances", dest="distances", required=False, action="store_true", help="[OPTIONAL] Compute the pairwise allele distances \
+						(number of loci called in both samples with different alleles) of the samples of this run against all the samples up to it and \
+						keep them in partition/distances.bin. '--max-cpus' sets the number of threads used (default: all available cpus).")
+	group2.add_argument("--distances-tsv", dest="distances_tsv", required=False, action="store_true", help="[OPTIONAL] Also write the square distance \
+						matrix of all the samples to distances.bin/distances.index.json and export it to distances.tsv (only used with '--distances').")
+	group2.add_argument("--clusters", dest="clusters", default="", type=str, help="[OPTIONAL] Comma-separated list of allele thresholds (e.g. 5,10,25) \
+						at which samples are grouped by single linkage (implies '--distances'). The clusters are added to the summary report (Cluster_<threshold>) \
+						and keep their names across runs chained with '--previous-run'. Merges of previous clusters are listed in cluster_merges.tsv.")
 
 	args = parser.parse_args()
 
@@ -348,7 +907,20 @@ def main():
 	if args.nextflow_config == "":
 		sys.exit("Please indicate a valid nextflow config!")
 	
-	if os.path.exists(args.output + "/" + args.run_name) and not args.only_reports:
+	thresholds = []
+	if args.clusters != "":
+		try:
+			thresholds = [int(threshold) for threshold in args.clusters.split(",")]
+		except ValueError:
+			sys.exit("Please indicate valid cluster thresholds (comma-separated integers)!")
+	if args.jobs < 1:
+		sys.exit("Please indicate a valid number of jobs!")
+	if args.parse_jobs < 1:
+		sys.exit("Please indicate a valid number of parse jobs!")
+	
+	if args.resume and args.only_reports:
+		sys.exit("Please indicate either '--resume' or '--only-reports'!")
+	if os.path.exists(args.output + "/" + args.run_name) and not args.only_reports and not args.resume:
 		sys.exit("There is another run with the same name... I cannot proceed :-( please remove the previous run or choose a different run name!")
 
 	print("\n******************** efsa_wgs_onehealth_facilitator.py ********************\n")
@@ -361,32 +933,101 @@ def main():
 	
 	species_code = {"listeria monocytogenes": "Lm", "salmonella enterica": "Se", "escherichia coli": "Ec"}
 
-	if not args.only_reports:
+	if not args.only_reports and not os.path.exists(args.output + "/" + args.run_name):
 		print("\nCreating the run directory...")
 		os.system("mkdir " + args.output + "/" + args.run_name)
-	sample_dirs, sample_names = distribute_fastq(args.fastq, args.sample_info, args.output + "/" + args.run_name, args.only_reports)
+	metrics = RunMetrics(args.output + "/" + args.run_name, args.profile)
+	ledger = RunLedger(args.output + "/" + args.run_name) if not args.only_reports else None
+	with metrics.stage("staging"):
+		sample_dirs, sample_names = distribute_fastq(args.fastq, args.sample_info, args.output + "/" + args.run_name, args.only_reports, args.stage_mode, args.stage_jobs, metrics, ledger)
 	
+	cache = ResultCache(args.output + "/" + args.run_name)
+	manifest = ResultManifest()
+	stream = None
+	profiles = {}
+	records = {}
+	if args.stream_reports and not args.only_reports:
+		stream = BackgroundStage(consume_sample_results, cache, manifest, profiles, records)
+
 	if not args.only_reports:
 		print("\nRunning EFSA pipeline...")
-		for directory in sample_dirs:
-			run_status = run_efsa_pipeline(directory, args.nextflow_config, args.species)
+		with metrics.stage("pipeline") as stage_metrics:
+			to_run = [directory for directory in sample_dirs if ledger.state(sample_names[directory]) != RunLedger.SUCCEEDED]
+			if args.resume:
+				print("\tResuming the run: " + str(len(sample_dirs) - len(to_run)) + " sample(s) already analysed, " + str(len(to_run)) + " to analyse")
+				for directory in to_run:
+					if ledger.state(sample_names[directory]) in [RunLedger.RUNNING, RunLedger.FAILED]:
+						clear_incomplete_outputs(directory)
+			to_analyse = to_run
+			if args.analysis_cache != "":
+				analysis_cache = AnalysisCache(args.analysis_cache, [efsa_workflow, args.nextflow_config], args.species)
+				cache_keys, to_analyse = restore_cached_analyses(analysis_cache, to_run, sample_names)
+				ledger.update([sample_names[directory] for directory in to_run if directory not in to_analyse], RunLedger.SUCCEEDED, 0)
+			if stream is not None:
+				for directory in sample_dirs:
+					if directory not in to_analyse:
+						stream.add(directory)
+			run_status = {directory: 0 for directory in sample_dirs}
+			if len(to_analyse) > 0 and args.batch:
+				run_status.update(run_efsa_pipeline_batch(args.output + "/" + args.run_name, to_analyse, {directory: sample_names[directory] for directory in to_analyse}, args.nextflow_config, args.species, args.max_cpus, args.max_mem, metrics, ledger, args.resume, stream))
+			elif len(to_analyse) > 0:
+				run_status.update(run_efsa_pipelines(to_analyse, args.nextflow_config, args.species, args.jobs, args.max_cpus, args.max_mem, metrics, ledger, args.resume, stream))
+			if args.analysis_cache != "":
+				for directory in to_analyse:
+					if run_status[directory] == 0 and directory in cache_keys:
+						analysis_cache.store(cache_keys[directory], directory, sample_names[directory])
+			failed_runs = [directory.split("/")[-1] for directory in sample_dirs if run_status[directory] != 0]
+			stage_metrics["samples"] = len(sample_dirs)
+			stage_metrics["already_analysed"] = len(sample_dirs) - len(to_run)
+			stage_metrics["restored_from_cache"] = len(to_run) - len(to_analyse)
+			stage_metrics["exit_codes"] = {directory.split("/")[-1]: run_status[directory] for directory in sample_dirs}
+		if len(failed_runs) > 0:
+			print("\tThe EFSA pipeline exited with an error for " + str(len(failed_runs)) + " sample(s): " + ", ".join(failed_runs))
 	
-	if args.only_reports:
-		os.system("rm " + args.output + "/" + args.run_name + "/alleles.tsv")
-		os.system("rm " + args.output + "/" + args.run_name + "/summary.tsv")
-		os.system("rm " + args.output + "/" + args.run_name + "/mlst.tsv")
-		os.system("rm " + args.output + "/" + args.run_name + "/amr.tsv")
-		os.system("rm " + args.output + "/" + args.run_name + "/pathotypes.tsv")
-		os.system("rm " + args.output + "/" + args.run_name + "/" + str(species_code[args.species]) + "_" + args.run_name + "_report.xlsx")
-		
+	if stream is not None:
+		with metrics.stage("stream_flush") as stage_metrics:
+			stream.close()
+			stage_metrics["samples"] = stream.consumed
+			stage_metrics["background_seconds"] = stream.busy_seconds
+		print("\tResults of " + str(stream.consumed) + " sample(s) read while the EFSA pipeline was running (flushed in " + str(round(stream.flush_seconds, 2)) + " s)")
+
+	store = RunStore.create(args.output + "/" + args.run_name, str(species_code[args.species]) + "_" + args.run_name + "_report.xlsx", args.previous_run)
+	os.makedirs(store.own_partition, exist_ok = True)
+
+	with metrics.stage("scan") as stage_metrics:
+		to_scan = [directory for directory in sample_dirs if directory not in manifest.samples]
+		manifest.samples.update(ResultManifest.scan(to_scan).samples)
+		stage_metrics["samples"] = len(to_scan)
+
 	print("\nMerging allele matrices...")
-	allele_matrix = join_allele_matrices(sample_dirs, args.previous_run)
-	allele_matrix.to_csv(args.output + "/" + args.run_name + "/alleles.tsv", index = False, header=True, sep ="\t")
+	with metrics.stage("allele_matrix", profiled = True) as stage_metrics:
+		allele_matrix = join_allele_matrices(sample_dirs, args.previous_run, manifest, profiles)
+		store.write_partition_alleles(allele_matrix)
+		stage_metrics["samples"] = len(allele_matrix.samples)
+		stage_metrics["loci"] = len(allele_matrix.loci)
 	
+	if args.distances or args.clusters != "":
+		print("\nComputing allele distances...")
+		with metrics.stage("distances"):
+			blocks = store.update_distances(args.max_cpus if args.max_cpus > 0 else os.cpu_count())
+		if args.clusters != "":
+			print("\nAssigning clusters...")
+			with metrics.stage("clusters"):
+				store.update_clusters(blocks, thresholds)
+
 	print("\nMerging reports...")
 	
-	failed, run_successful_samples = join_reports_efsa_parser(args.output, sample_dirs, args.run_name, args.species, species_code)
-	prepare_final_reports(args.output, args.run_name, failed, args.previous_run, run_successful_samples, args.species, species_code)
+	with metrics.stage("parsing", profiled = True) as stage_metrics:
+		failed, reports = join_reports_efsa_parser(sample_dirs, args.parse_jobs, cache, manifest, records)
+		cache.save()
+		stage_metrics["cache_hits"] = cache.hits
+		stage_metrics["cache_misses"] = cache.misses
+	print("\tResult cache: " + str(cache.hits) + " file(s) reused, " + str(cache.misses) + " parsed")
+	with metrics.stage("final_reports", profiled = True):
+		prepare_final_reports(failed, store, reports, args.lazy_views, metrics, manifest, args.distances_tsv)
+		if args.distances_tsv and not args.lazy_views and DistanceMatrix.exists(args.output + "/" + args.run_name):
+			DistanceMatrix.load(args.output + "/" + args.run_name).to_tsv(args.output + "/" + args.run_name + "/distances.tsv")
+	metrics.save(version = version, command = " ".join(sys.argv))
 
 	end = datetime.datetime.now()
 	elapsed = end - start